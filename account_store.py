@@ -0,0 +1,180 @@
+"""
+On-disk state of the accounts in SQLite, so a restarted guard.py schedules
+every account when its cool-down ends instead of all at once, and skips the
+cookies known to be invalid without sending a request.
+
+accounts table, one row for every DedeUserID:
+cookie_hash - SHA-1 of the cookies, the state is reset when they change,
+              e.g., after logging in again
+valid       - 0 after the account is retired because of -101
+ready_at    - seconds since the epoch when the cool-down ends
+failures    - -101 responses with the current cookies, the same counter
+              as util.process_status_101, which retires the account at 10
+updated_at  - seconds since the epoch of the last change
+"""
+
+import asyncio
+import collections
+import hashlib
+import sqlite3
+import threading
+import time
+import logger
+
+__all__ = ["AccountStore", "AccountState", "add_account_store_argument"]
+
+LOGGER = logger.get_logger('account_store')
+
+STORE_PATH = "accounts.db"
+
+AccountState = collections.namedtuple(
+    "AccountState", ["cookie_hash", "valid", "ready_at", "failures"])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    user_id TEXT PRIMARY KEY,
+    cookie_hash TEXT NOT NULL,
+    valid INTEGER NOT NULL,
+    ready_at REAL NOT NULL,
+    failures INTEGER NOT NULL,
+    updated_at REAL NOT NULL
+)
+"""
+
+
+def cookie_hash(cookies):
+    text = "; ".join("%s=%s" % item for item in sorted(cookies.items()))
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class AccountStore(object):
+    """Keep the AccountState of every account in memory and write the
+    changed ones to the database in one transaction by flush(), so a draw
+    never waits for the disk, keep_saved() writes them in an executor so the
+    event loop doesn't either
+    """
+
+    def __init__(self, filename=STORE_PATH):
+        self.filename = filename
+        # the connection is used by the executor threads of keep_saved()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self._db_lock = threading.Lock()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(SCHEMA)
+        self.db.commit()
+        self.states = {}
+        for user_id, digest, valid, ready_at, failures in self.db.execute(
+                "SELECT user_id, cookie_hash, valid, ready_at, failures "
+                "FROM accounts"):
+            self.states[user_id] = AccountState(digest, bool(valid),
+                                                ready_at, failures)
+        # user ids changed since the last flush
+        self._dirty = set()
+
+    def _set(self, user_id, state):
+        self.states[user_id] = state
+        self._dirty.add(user_id)
+
+    def register(self, user_id, cookies):
+        """return the state of an account of the user file, a new account
+        or an account with different cookies starts as valid and ready
+        """
+        digest = cookie_hash(cookies)
+        state = self.states.get(user_id)
+        if state is None or state.cookie_hash != digest:
+            state = AccountState(digest, True, 0.0, 0)
+            self._set(user_id, state)
+        return state
+
+    def wait_time(self, user_id):
+        """seconds until the cool-down of the account ends
+        """
+        state = self.states.get(user_id)
+        if state is None:
+            return 0
+        return max(state.ready_at - time.time(), 0)
+
+    def failures(self):
+        """return {user_id: failures}, to restore the counters of
+        util.process_status_101
+        """
+        return {user_id: state.failures
+                for user_id, state in self.states.items() if state.failures}
+
+    def record(self, user_id, result):
+        """update the account with the DrawResult of its request, None if
+        the account is retired because of an invalid cookie
+        """
+        state = self.states.get(user_id)
+        if state is None:
+            return
+        if result is None:
+            # the -101 response retiring the account is a failure too
+            state = state._replace(failures=state.failures + 1,
+                                   valid=False)
+        elif result.status_code is None:
+            # no response, nothing is learned
+            return
+        elif result.status_code == -101:
+            state = state._replace(ready_at=time.time() + result.wait_time,
+                                   failures=state.failures + 1)
+        else:
+            state = state._replace(ready_at=time.time() + result.wait_time)
+        self._set(user_id, state)
+
+    def track(self, handler):
+        """wrap a Dispatcher handler to record the result of every account
+        """
+        async def tracked(account, task):
+            result = await handler(account, task)
+            self.record(account.user_id, result)
+            return result
+        return tracked
+
+    def _take_rows(self):
+        """return the rows of the accounts changed since the last call
+        """
+        now = time.time()
+        rows = []
+        for user_id in self._dirty:
+            digest, valid, ready_at, failures = self.states[user_id]
+            rows.append((user_id, digest, int(valid), ready_at, failures,
+                         now))
+        self._dirty.clear()
+        return rows
+
+    def _write(self, rows):
+        with self._db_lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO accounts VALUES (?, ?, ?, ?, ?, ?)",
+                rows)
+            self.db.commit()
+
+    def flush(self):
+        rows = self._take_rows()
+        if rows:
+            self._write(rows)
+
+    async def keep_saved(self, loop, interval=5):
+        """write the changes every interval seconds in an executor, the rows
+        are taken in the event loop so the states are never read by another
+        thread
+        """
+        while True:
+            await asyncio.sleep(interval, loop=loop)
+            rows = self._take_rows()
+            if rows:
+                await loop.run_in_executor(None, self._write, rows)
+
+    def close(self):
+        self.flush()
+        with self._db_lock:
+            self.db.close()
+
+
+def add_account_store_argument(parser):
+    parser.add_argument('--account-store', nargs='?', const=STORE_PATH,
+                        metavar='path',
+                        help="keep the cool-downs and invalid cookies of the "
+                        "accounts across restarts, default path %s" %
+                        STORE_PATH)
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+"""
+Offline benchmarks of the hot paths, with synthetic data from fixed seeds.
+
+    python benchmark.py -o before.json
+    python benchmark.py --compare before.json
+
+The fast paths are also checked against their reference implementations
+before measuring, use --skip-checks to only measure.
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import numpy as np
+from PIL import Image
+from util import CODE_COLOR_TABLE, COLOR_CODE_TABLE, missing_color_table,\
+    process_tasks, hex_to_rgb
+from canvas import Canvas
+from update_image import UpdateImage
+from frame_parser import parse_frame, parse_frame_slow, read_corpus,\
+    synthetic_frames
+from pixel_queue import PixelQueue
+from pollution import PollutionTracker
+from process_image import convert_image
+from generate_tasks import generate_rect_tasks, generate_pattern_tasks,\
+    write_tasks
+from merge_tasks import merge_tasks, sort_tasks
+import logger
+
+WIDTH = 1280
+HEIGHT = 720
+
+# colors accepted by process_tasks, the palette and the known missing colors
+TASK_COLORS = sorted(set(COLOR_CODE_TABLE) | {
+    rgb_hex for rgb_hex, replacement in missing_color_table.items()
+    if replacement in COLOR_CODE_TABLE})
+
+
+def random_board(rng, width=WIDTH, height=HEIGHT):
+    codes = list(CODE_COLOR_TABLE.keys())
+    return ''.join(rng.choice(codes) for _ in range(width * height))
+
+
+def random_tasks(rng, count, width=WIDTH, height=HEIGHT):
+    """return count tasks of distinct random pixels
+    """
+    return [(index % width, index // width, rng.choice(TASK_COLORS))
+            for index in rng.sample(range(width * height), count)]
+
+
+def random_image(rng, width, height, mode="RGB"):
+    state = np.random.RandomState(rng.randrange(1 << 32))
+    data = state.randint(0, 256, (height, width, len(mode)), dtype=np.uint8)
+    if mode == "RGBA":
+        # a quarter of the pixels are transparent
+        data[:, :, 3] = np.where(state.random_sample((height, width)) < 0.25,
+                                 0, 255)
+    return Image.fromarray(data, mode)
+
+
+def measure(func, repeat):
+    """return the seconds of every run
+    """
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start_time)
+    return times
+
+
+def convert_code_to_bytes_slow(CODE_COLOR_TABLE, code_data, buf):
+    """reference implementation of decoding a code string into RGB bytes,
+    looking up every pixel in Python
+    """
+    i = 0
+    for code in code_data:
+        rgb_hex = CODE_COLOR_TABLE[code]
+        rgb = hex_to_rgb(rgb_hex)
+        buf[i:i + 3] = rgb
+        i += 3
+    return buf
+
+
+def check_convert(rng, boards):
+    """compare Canvas.load_codes and to_rgb_bytes with the reference
+    implementation on random boards
+    """
+    canvas = Canvas()
+    for _ in range(boards):
+        code_data = random_board(rng)
+        canvas.load_codes(code_data)
+        slow = convert_code_to_bytes_slow(CODE_COLOR_TABLE, code_data,
+                                          bytearray(len(code_data) * 3))
+        assert canvas.to_rgb_bytes() == slow, "to_rgb_bytes mismatch"
+
+
+def mutate_frame(rng, frame):
+    frame = bytearray(frame)
+    choice = rng.randrange(3)
+    if choice == 0:
+        # flip some bits
+        for _ in range(rng.randint(1, 4)):
+            frame[rng.randrange(len(frame))] ^= 1 << rng.randrange(8)
+    elif choice == 1:
+        # truncate
+        del frame[rng.randrange(len(frame)):]
+    else:
+        # overwrite a byte with a JSON special character
+        frame[rng.randrange(len(frame))] = rng.choice(b'{}":,0 ')
+    return bytes(frame)
+
+
+def fuzz_parser(rng, frames, rounds):
+    """parse_frame must agree with the json.loads based reference on both
+    recorded and mutated frames
+    """
+    # broken frames are expected to be logged
+    logger.get_logger('frame_parser').disabled = True
+    for frame in frames:
+        assert parse_frame(frame) == parse_frame_slow(frame), frame
+    for _ in range(rounds):
+        frame = mutate_frame(rng, rng.choice(frames))
+        assert parse_frame(frame) == parse_frame_slow(frame), frame
+    logger.get_logger('frame_parser').disabled = False
+
+
+# every setup function prepares the data of a benchmark and returns the
+# function to be measured
+
+
+def setup_to_rgb_bytes(rng, args):
+    canvas = Canvas()
+    canvas.load_codes(random_board(rng))
+    return canvas.to_rgb_bytes
+
+
+def setup_load_codes(rng, args):
+    code_data = random_board(rng)
+    canvas = Canvas()
+    return lambda: canvas.load_codes(code_data)
+
+
+def setup_parse_frame(rng, args):
+    frames = args.frames
+
+    def run():
+        for frame in frames:
+            parse_frame(frame)
+    return run
+
+
+class GuardStub(object):
+    """the state of an UpdateImage guarding a region, with its own
+    process_message and apply_updates, but no session or WebSocket
+    """
+    process_message = UpdateImage.process_message
+    apply_updates = UpdateImage.apply_updates
+    get_task_priority = UpdateImage.get_task_priority
+
+    def __init__(self, canvas, guard_region, task_queue):
+        self.canvas = canvas
+        self.guard_region = guard_region
+        self.guard_priority = {}
+        self.defualt_priority = 0
+        self.task_queue = task_queue
+        self.tracker = PollutionTracker(canvas, guard_region)
+        self.update_callback = None
+        self._pending_updates = []
+        self.updates_applied = 0
+        self.update_time = 0.0
+
+
+def setup_process_message(rng, args):
+    """a guard with 100000 pixels receiving the frames
+    """
+    frames = args.frames
+    loop = asyncio.new_event_loop()
+    canvas = Canvas()
+    canvas.load_codes(random_board(rng))
+    up = GuardStub(canvas, process_tasks(random_tasks(rng, 100000)),
+                   PixelQueue(loop=loop))
+    up.tracker.rescan()
+    args.cleanup.append(loop.close)
+    # the guard logs every polluted pixel
+    logger.get_logger('update_image').disabled = True
+
+    def run():
+        for frame in frames:
+            up.process_message(frame)
+    return run
+
+
+def setup_rescan(rng, args):
+    """find the polluted pixels of 100000 pixels from scratch
+    """
+    canvas = Canvas()
+    canvas.load_codes(random_board(rng))
+    tracker = PollutionTracker(canvas, process_tasks(random_tasks(rng,
+                                                                  100000)))
+
+    def run():
+        tracker.polluted.clear()
+        tracker.rescan()
+    return run
+
+
+def setup_process_tasks(rng, args):
+    tasks = random_tasks(rng, 100000)
+    return lambda: process_tasks(tasks)
+
+
+def setup_process_image(rng, args):
+    image = random_image(rng, 512, 512, "RGBA")
+    return lambda: convert_image(image)
+
+
+def setup_generate_tasks(rng, args):
+    """generate and write the tasks of a 400x300 rectangle and a 200x200
+    pattern
+    """
+    img_rgb = random_image(rng, WIDTH, HEIGHT)
+    img_pattern = random_image(rng, 200, 200, "RGBA")
+    fd, filename = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    args.cleanup.append(lambda: os.remove(filename))
+
+    def run():
+        parts = [generate_rect_tasks(img_rgb, (100, 100, 499, 399)),
+                 generate_pattern_tasks(img_pattern, (600, 300),
+                                        img_rgb.size)]
+        xs, ys, packed = (np.concatenate(arrays) for arrays in zip(*parts))
+        write_tasks(filename, xs, ys, packed, img_rgb.size)
+    return run
+
+
+def setup_merge_tasks(rng, args):
+    """merge three overlapping task files, remove one and sort by y
+    """
+    task_lists = [random_tasks(rng, 50000) for _ in range(3)]
+    exclude_lists = [random_tasks(rng, 10000)]
+
+    def run():
+        sort_tasks(merge_tasks(task_lists, exclude_lists), sort_by_y=True)
+    return run
+
+
+BENCHMARKS = collections.OrderedDict([
+    ("to_rgb_bytes", setup_to_rgb_bytes),
+    ("load_codes", setup_load_codes),
+    ("parse_frame", setup_parse_frame),
+    ("process_message", setup_process_message),
+    ("rescan", setup_rescan),
+    ("process_tasks", setup_process_tasks),
+    ("process_image", setup_process_image),
+    ("generate_tasks", setup_generate_tasks),
+    ("merge_tasks", setup_merge_tasks),
+])
+
+
+def run_benchmarks(names, args):
+    results = collections.OrderedDict()
+    for name in names:
+        # the same data whichever benchmarks are selected
+        rng = random.Random("%d-%s" % (args.seed, name))
+        func = BENCHMARKS[name](rng, args)
+        # warm up caches, e.g., the palette lookup table
+        func()
+        times = measure(func, args.repeat)
+        results[name] = {"best": min(times),
+                         "median": statistics.median(times),
+                         "repeat": len(times)}
+        print("%-24s best %.6fs, median %.6fs" %
+              (name, results[name]["best"], results[name]["median"]))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """print the change of the best time of every benchmark, return the
+    names of the regressed ones
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]["best"]
+        after = result["best"]
+        change = (after - before) / before
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("%-24s %.6fs -> %.6fs %+7.1f%%%s" %
+              (name, before, after, change * 100, flag))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('names', nargs='*', metavar='benchmark',
+                        help="run only these benchmarks, choose from %s" %
+                        ", ".join(BENCHMARKS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('-o', dest='output_filename',
+                        help="save the results as JSON")
+    parser.add_argument('--compare', dest='baseline_filename',
+                        help="compare with the results saved by -o, exit "
+                        "with status 1 if any benchmark regressed")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="slowdown ratio regarded as a regression")
+    parser.add_argument('--skip-checks', action='store_true',
+                        help="skip the equivalence checks and fuzzing")
+    parser.add_argument('--boards', type=int, default=3,
+                        help="number of random boards for equivalence check")
+    parser.add_argument('--corpus', dest='corpus_filename',
+                        help="recorded WebSocket frames, synthetic frames are"
+                        " used if it is not given")
+    parser.add_argument('--fuzz', type=int, default=10000,
+                        help="number of mutated frames for fuzzing")
+    args = parser.parse_args()
+    names = args.names or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark %s" % name)
+
+    rng = random.Random(args.seed)
+    if args.corpus_filename:
+        args.frames = read_corpus(args.corpus_filename)
+    else:
+        args.frames = list(synthetic_frames(rng, 5000))
+    args.cleanup = []
+
+    if not args.skip_checks:
+        check_convert(rng, args.boards)
+        print("to_rgb_bytes: %d random boards match" % args.boards)
+        fuzz_parser(rng, args.frames, args.fuzz)
+        print("parse_frame: %d frames and %d mutated frames match" %
+              (len(args.frames), args.fuzz))
+
+    try:
+        results = run_benchmarks(names, args)
+    finally:
+        for cleanup in args.cleanup:
+            cleanup()
+
+    if args.output_filename:
+        with open(args.output_filename, "w") as fp:
+            json.dump({"seed": args.seed,
+                       "python": platform.python_version(),
+                       "machine": platform.machine(),
+                       "results": results}, fp, indent=2)
+        print("Save results to %s" % args.output_filename)
+
+    if args.baseline_filename:
+        with open(args.baseline_filename, "r") as fp:
+            baseline = json.load(fp)
+        if baseline["seed"] != args.seed:
+            print("Warning: the baseline uses seed %d" % baseline["seed"])
+        regressions = compare(results, baseline["results"], args.threshold)
+        if regressions:
+            print("%d benchmarks regressed: %s" %
+                  (len(regressions), ", ".join(regressions)))
+            sys.exit(1)
@@ -0,0 +1,86 @@
+from PIL import Image
+from util import PALETTE_CODES, CODE_INDEX_TABLE, CODE_RGB_TABLE
+
+__all__ = ["Canvas", "indexes_to_image"]
+
+# color code byte -> palette index, for bytes.translate()
+CODE_TO_INDEX = bytearray(256)
+for code, index in CODE_INDEX_TABLE.items():
+    CODE_TO_INDEX[ord(code)] = index
+CODE_TO_INDEX = bytes(CODE_TO_INDEX)
+
+VALID_CODES = PALETTE_CODES.encode('ascii')
+
+# palette index -> red, green and blue value, for bytes.translate()
+CHANNEL_TABLES = tuple(
+    bytes(bytearray([CODE_RGB_TABLE[code][channel] for code in PALETTE_CODES])
+          + bytearray(256 - len(PALETTE_CODES)))
+    for channel in range(3)
+)
+
+# palette index -> (r, g, b)
+INDEX_RGB_LIST = [CODE_RGB_TABLE[code] for code in PALETTE_CODES]
+
+# palette of "P" mode images, r, g, b of every palette index
+PALETTE_DATA = bytes(value for rgb in INDEX_RGB_LIST for value in rgb)
+
+
+class Canvas(object):
+    """Sketch board stored as one palette index byte per pixel
+    """
+
+    def __init__(self, width=1280, height=720, buffer=None):
+        self.width = width
+        self.height = height
+        if buffer is None:
+            buffer = bytearray(width * height)
+        self.buffer = buffer
+
+    def get_index(self, x, y):
+        return self.buffer[y * self.width + x]
+
+    def set_index(self, x, y, index):
+        self.buffer[y * self.width + x] = index
+
+    def get_code(self, x, y):
+        return PALETTE_CODES[self.buffer[y * self.width + x]]
+
+    def set_code(self, x, y, color_code):
+        self.buffer[y * self.width + x] = CODE_INDEX_TABLE[color_code]
+
+    def get_rgb(self, x, y):
+        return INDEX_RGB_LIST[self.buffer[y * self.width + x]]
+
+    def load_codes(self, code_data):
+        """replace the whole canvas with the code string of
+        /SummerDraw/bitmap
+        """
+        if isinstance(code_data, str):
+            code_data = code_data.encode('ascii')
+        if len(code_data) != self.width * self.height:
+            raise ValueError("Code data length mismatch: %d" %
+                             len(code_data))
+        # translate() silently maps unknown codes, check them explicitly
+        unknown = code_data.translate(None, VALID_CODES)
+        if unknown:
+            raise KeyError(chr(unknown[0]))
+        self.buffer[:] = code_data.translate(CODE_TO_INDEX)
+
+    def to_rgb_bytes(self):
+        buf = bytearray(self.width * self.height * 3)
+        indexes = bytes(self.buffer)
+        for channel, table in enumerate(CHANNEL_TABLES):
+            buf[channel::3] = indexes.translate(table)
+        return buf
+
+    def to_image(self):
+        """return a "P" mode image with the fixed palette, it is saved as GIF
+        or PNG without quantization
+        """
+        return indexes_to_image(bytes(self.buffer), self.width, self.height)
+
+
+def indexes_to_image(indexes, width=1280, height=720):
+    img = Image.frombytes("P", (width, height), indexes)
+    img.putpalette(PALETTE_DATA)
+    return img
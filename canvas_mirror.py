@@ -0,0 +1,126 @@
+"""
+Memory-mapped sketch board shared by the mirror daemon (mirror.py) and the
+tools attached to it.
+
+Mirror file layout:
+
+8 - magic "BDMIRROR"
+2 - width
+2 - height
+4 - padding
+8 - sequence number, increased after every change
+8 - (double) time of the last full update, 0 if never updated
+width * height - palette index of every pixel, see canvas.Canvas
+
+Change notifications sent to every client of the local socket:
+
+1 - kind, "U" for updates, "F" for a full update
+8 - sequence number after the change
+2 - number of updates, 0 for a full update
+5 * number of updates - x (2), y (2) and palette index (1)
+"""
+
+import os
+import mmap
+import struct
+import tempfile
+from canvas import Canvas
+from util import PALETTE_CODES, CODE_INDEX_TABLE
+
+__all__ = ["MirrorFile", "MIRROR_PATH", "add_mirror_argument",
+           "encode_updates", "encode_full_update", "read_notification"]
+
+MIRROR_PATH = os.path.join(tempfile.gettempdir(), "bdraw_canvas.mmap")
+SOCKET_SUFFIX = ".sock"
+MAGIC = b"BDMIRROR"
+
+header_struct = struct.Struct("<8sHH4xQd")
+SEQ_OFFSET = 16
+seq_struct = struct.Struct("<Qd")
+notification_struct = struct.Struct("!cQH")
+update_struct = struct.Struct("!HHB")
+
+KIND_UPDATE = b"U"
+KIND_FULL = b"F"
+
+
+class MirrorFile(object):
+    """The mirror file mapped into memory, writable for the daemon and
+    read-only for the other tools
+    """
+
+    def __init__(self, path=MIRROR_PATH, width=1280, height=720,
+                 create=False):
+        self.path = path
+        self.socket_path = path + SOCKET_SUFFIX
+        size = header_struct.size + width * height
+        if create:
+            # never truncate, tools may still map the file of the previous
+            # daemon
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            with open(fd, "r+b") as fp:
+                fp.truncate(size)
+                fp.write(header_struct.pack(MAGIC, width, height, 0, 0.0))
+        with open(path, "r+b" if create else "rb") as fp:
+            access = mmap.ACCESS_WRITE if create else mmap.ACCESS_READ
+            self.mm = mmap.mmap(fp.fileno(), 0, access=access)
+
+        magic, width, height, _, _ = header_struct.unpack_from(self.mm)
+        if magic != MAGIC:
+            raise ValueError("%s is not a mirror file" % path)
+        self.view = memoryview(self.mm)
+        self.canvas = Canvas(width, height,
+                             self.view[header_struct.size:size])
+
+    @property
+    def seq(self):
+        return seq_struct.unpack_from(self.mm, SEQ_OFFSET)[0]
+
+    @property
+    def last_full_update(self):
+        last_full_update = seq_struct.unpack_from(self.mm, SEQ_OFFSET)[1]
+        return last_full_update or None
+
+    def publish(self, last_full_update=None):
+        """increase the sequence number, return the new one
+        """
+        seq, last = seq_struct.unpack_from(self.mm, SEQ_OFFSET)
+        if last_full_update is None:
+            last_full_update = last
+        seq_struct.pack_into(self.mm, SEQ_OFFSET, seq + 1, last_full_update)
+        return seq + 1
+
+    def close(self):
+        self.canvas.buffer.release()
+        self.view.release()
+        self.mm.close()
+
+
+def add_mirror_argument(parser):
+    parser.add_argument('--mirror', nargs='?', const=MIRROR_PATH,
+                        metavar='path',
+                        help="attach to the board kept by mirror.py instead "
+                        "of downloading it, default path %s" % MIRROR_PATH)
+
+
+def encode_updates(seq, update_list):
+    data = bytearray(notification_struct.pack(KIND_UPDATE, seq,
+                                              len(update_list)))
+    for x, y, color_code in update_list:
+        data += update_struct.pack(x, y, CODE_INDEX_TABLE[color_code])
+    return bytes(data)
+
+
+def encode_full_update(seq):
+    return notification_struct.pack(KIND_FULL, seq, 0)
+
+
+async def read_notification(reader):
+    """return kind, sequence number and the list of (x, y, color_code)
+    """
+    kind, seq, count = notification_struct.unpack(
+        await reader.readexactly(notification_struct.size))
+    data = await reader.readexactly(count * update_struct.size)
+    update_list = [(x, y, PALETTE_CODES[index]) for x, y, index
+                   in update_struct.iter_unpack(data)]
+    return kind, seq, update_list
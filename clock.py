@@ -122,18 +122,17 @@ class ClockPlugin(object):
             index = x * 3
             desired_rgb = tuple(slice_image_data[index:index + 3])
             desired_code = RGB_CODE_TABLE[desired_rgb]
-            index = ((y + BASE_TOP) * self.up.width +
-                     BASE_X + BASE_LEFT + x) * 3
-            current_rgb = tuple(self.up.image_buffer[index:index + 3])
             real_x = BASE_LEFT + BASE_X + x
             real_y = BASE_TOP + y
-            if desired_rgb != current_rgb:
+            current_code = self.up.canvas.get_code(real_x, real_y)
+            if desired_code != current_code:
                 # print("[CLOCK] not match (%d,%d) des %s, cur %s" %
-                #      (real_x, real_y, desired_rgb, current_rgb))
+                #      (real_x, real_y, desired_code, current_code))
                 tasks.append((real_x, real_y, desired_code))
 
             if self.up.guard_region:
                 self.up.guard_region[(real_x, real_y)] = desired_code
+                self.up.tracker.set_target(real_x, real_y, desired_code)
 
         next_stage = current_stage.step()
         if next_stage == HourStage.s0:
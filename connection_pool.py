@@ -0,0 +1,206 @@
+import asyncio
+import aiohttp
+from yarl import URL
+import logger
+from util import post_url, fake_request_header
+
+__all__ = ["ConnectionPool", "PooledConnector", "add_pool_arguments"]
+
+LOGGER = logger.get_logger('connection_pool')
+
+# a cheap request to open or refresh keep-alive connections
+WARMUP_URL = str(URL(post_url).origin())
+
+
+class PooledConnector(aiohttp.TCPConnector):
+    """TCPConnector which records how connections are acquired, the new
+    connections are recorded by the sessions using trace_config
+    """
+
+    def __init__(self, *args, loop=None, **kwargs):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        super().__init__(*args, loop=loop, **kwargs)
+        self.loop = loop
+        self.trace_config = aiohttp.TraceConfig()
+        self.trace_config.on_connection_create_start.append(
+            self._on_create_start)
+        self.trace_config.on_connection_create_end.append(
+            self._on_create_end)
+        self.acquired = 0
+        self.created = 0
+        # seconds spent in connect(), and in creating new connections
+        self.connect_time = 0.0
+        self.create_time = 0.0
+        self.max_connect_time = 0.0
+
+    async def connect(self, req, *args, **kwargs):
+        start_time = self.loop.time()
+        try:
+            return await super().connect(req, *args, **kwargs)
+        finally:
+            cost = self.loop.time() - start_time
+            self.acquired += 1
+            self.connect_time += cost
+            self.max_connect_time = max(self.max_connect_time, cost)
+
+    async def _on_create_start(self, session, context, params):
+        context.create_start = self.loop.time()
+
+    async def _on_create_end(self, session, context, params):
+        self.created += 1
+        self.create_time += self.loop.time() - context.create_start
+
+    def idle(self):
+        """number of idle keep-alive connections
+        """
+        # aiohttp has no public accessor of the keep-alive connections
+        return sum(len(conns) for conns in self._conns.values())
+
+    def stats(self):
+        reused = self.acquired - self.created
+        return {
+            "acquired": self.acquired,
+            "created": self.created,
+            "reused": reused,
+            "reuse_rate": reused / self.acquired if self.acquired else 0.0,
+            # waiting for a free connection, excluding TCP setup and DNS
+            "wait_time": max(self.connect_time - self.create_time, 0.0),
+            "create_time": self.create_time,
+            "max_connect_time": self.max_connect_time,
+            "idle": self.idle(),
+        }
+
+
+def add_pool_arguments(parser):
+    group = parser.add_argument_group("connection pool")
+    group.add_argument('--limit', type=int, default=100,
+                       help="max number of connections, 0 for no limit")
+    group.add_argument('--limit-per-host', type=int, default=0,
+                       help="max number of connections to a host, 0 for no"
+                       " limit")
+    group.add_argument('--keepalive', type=float, default=60,
+                       help="seconds to keep idle connections")
+    group.add_argument('--dns-ttl', type=int, default=600,
+                       help="seconds to cache DNS results")
+    group.add_argument('--warmup-lead', type=float, default=0,
+                       help="open connections this many seconds before "
+                       "accounts are ready, it pays off when there are more "
+                       "accounts than --limit, 0 to disable (default)")
+
+
+class ConnectionPool(object):
+    """Shared connector of every account session, with cached DNS and
+    keep-alive connections opened just before scheduled draws
+    """
+
+    def __init__(self, *, loop=None, limit=100, limit_per_host=0,
+                 keepalive_timeout=60, dns_ttl=600, warmup_lead=0):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        self.warmup_lead = warmup_lead
+        self.limit_per_host = limit_per_host
+        self.connector = PooledConnector(
+            loop=loop, limit=limit, limit_per_host=limit_per_host,
+            keepalive_timeout=keepalive_timeout, use_dns_cache=True,
+            ttl_dns_cache=dns_ttl)
+        # the session of the warm-up requests closes the connector
+        self.session = aiohttp.ClientSession(
+            connector=self.connector, loop=loop,
+            trace_configs=[self.connector.trace_config])
+        # sessions of the accounts
+        self.sessions = []
+        self.warmups = 0
+        self._warming = False
+
+    @classmethod
+    def from_args(cls, args, loop=None):
+        return cls(loop=loop, limit=args.limit,
+                   limit_per_host=args.limit_per_host,
+                   keepalive_timeout=args.keepalive, dns_ttl=args.dns_ttl,
+                   warmup_lead=args.warmup_lead)
+
+    def create_session(self, cookies):
+        session = aiohttp.ClientSession(
+            connector=self.connector, loop=self.loop, cookies=cookies,
+            connector_owner=False,
+            trace_configs=[self.connector.trace_config])
+        self.sessions.append(session)
+        return session
+
+    async def warmup(self, count):
+        """open count new connections, the requests take the idle connections
+        first, so they are refreshed by the same requests
+        """
+        if count <= 0 or self._warming:
+            return
+        self._warming = True
+        self.warmups += 1
+        try:
+            requests = self.connector.idle() + count
+            await asyncio.gather(*[self._touch() for _ in range(requests)],
+                                 loop=self.loop, return_exceptions=True)
+        finally:
+            self._warming = False
+
+    async def _touch(self):
+        async with self.session.head(WARMUP_URL, headers=fake_request_header,
+                                     timeout=10):
+            pass
+
+    def free_slots(self, in_use):
+        """number of connections which can still be opened, None for no
+        limit
+        """
+        limits = [limit - self.connector.idle() - in_use
+                  for limit in (self.connector.limit, self.limit_per_host)
+                  if limit]
+        return max(min(limits), 0) if limits else None
+
+    def warmup_count(self, dispatcher):
+        """return the number of connections to open for the accounts that
+        will be ready within warmup_lead seconds, the ones which are idle or
+        used by draws in flight are subtracted, up to the free slots of the
+        connector
+        """
+        if self.warmup_lead <= 0 or self._warming:
+            return 0
+        in_use = dispatcher.busy()
+        count = (dispatcher.upcoming(self.warmup_lead) -
+                 self.connector.idle() - in_use)
+        free = self.free_slots(in_use)
+        if free is not None:
+            count = min(count, free)
+        return max(count, 0)
+
+    async def keep_warm(self, dispatcher, report_interval=600):
+        """warm up connections for the accounts that will be ready within
+        warmup_lead seconds, and log the pool statistics periodically
+        """
+        interval = report_interval
+        if self.warmup_lead > 0:
+            interval = self.warmup_lead / 2
+        last_report = self.loop.time()
+        while True:
+            count = self.warmup_count(dispatcher)
+            if count:
+                asyncio.ensure_future(self.warmup(count), loop=self.loop)
+            if self.loop.time() - last_report > report_interval:
+                LOGGER.info("connection pool: %s" % self.summary())
+                last_report = self.loop.time()
+            await asyncio.sleep(interval, loop=self.loop)
+
+    def summary(self):
+        stats = self.connector.stats()
+        return ("%(acquired)d acquired, reuse rate %(reuse_rate).2f, "
+                "%(wait_time).2fs waiting for connections, "
+                "%(create_time).2fs creating connections, "
+                "%(idle)d idle" % stats)
+
+    async def close(self):
+        """close the sessions of the accounts, then the connector
+        """
+        for session in self.sessions:
+            await session.close()
+        await self.session.close()
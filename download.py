@@ -1,29 +1,32 @@
 #!/usr/bin/env python3
 
+import argparse
 import asyncio
 from datetime import datetime
-import sys
+from canvas_mirror import add_mirror_argument
 from update_image import UpdateImage
 
 filename_template = "autosave_{:%Y_%m_%d-%H_%M_%S}.gif"
 
 
-async def downloading(up):
+async def downloading(up, filename):
     await up.perform_update_image()
-    filename = filename_template.format(datetime.now())
     up.save_buffer_to_file(filename)
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        output_filename = filename_template.format(datetime.now())
-    else:
-        output_filename = sys.argv[1]
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output_filename', nargs='?',
+                        default=filename_template.format(datetime.now()))
+    add_mirror_argument(parser)
+    args = parser.parse_args()
+    output_filename = args.output_filename
 
     print("Downloading current sketch board screenshot")
-    up = UpdateImage()
+    up = UpdateImage(mirror=args.mirror)
     loop = asyncio.get_event_loop()
     try:
-        loop.run_until_complete(asyncio.gather(downloading(up)))
+        loop.run_until_complete(
+            asyncio.gather(downloading(up, output_filename)))
     except KeyboardInterrupt:
         print("Ctrl+C pressed, existing")
     finally:
@@ -1,84 +1,99 @@
 #!/usr/bin/env python3
 
-import json
 import sys
+import argparse
+import functools
 import asyncio
 import collections
 from update_image import UpdateImage
+from scheduler import Account, Dispatcher, DrawResult
 import logger
-from util import process_tasks, RGB_CODE_TABLE,\
-    async_draw_pixel_with_requests, extract_cookies, process_status_101
-import aiohttp
+from util import async_draw_pixel_with_requests, extract_cookies,\
+    process_status_101
+from task_file import load_tasks_dict
+from canvas_mirror import add_mirror_argument
+from connection_pool import ConnectionPool, add_pool_arguments
+from metrics import Metrics, MetricsServer, add_metrics_argument
+from profiling import Profiler, add_profile_arguments
 
 
 LOGGER = logger.get_logger('guard')
 
 
-async def task_main(worker_id, user_id, session, task_queue, total, up,
-                    user_counters, workers):
-    LOGGER.info("<worker-%s> start working" % worker_id)
-    wait_time = -1
-    while True:
-        index, x, y, color_code = await task_queue.get()
-        while True:
-            # check if it is already the correct color_code
-            current_rgb = up.get_image_pixel(x, y)
-            current_color_code = RGB_CODE_TABLE[current_rgb]
-            wait_time = -1
-            if current_color_code == color_code:
-                LOGGER.debug(
-                    "[%d/%d] <worker-%s> skip correct pixel (%d, %d)" %
-                    (index, total, worker_id, x, y))
-                task_queue.task_done()
-                break
-
-            # output may be an empty string
-            LOGGER.debug("<worker-%s> start to draw (%d, %d)" %
-                         (worker_id, x, y))
-
-            status_code, wait_time, cost_time = \
-                await async_draw_pixel_with_requests(session, x, y, color_code)
-
-            if status_code == 0:
-                LOGGER.info(
-                    "[%d/%d] <worker-%s> draw (%d, %d) with %s, status:"
-                    " %d, cost %.2fs" %
-                    (index, total, worker_id, x, y, color_code, status_code, cost_time))
-                task_queue.task_done()
-            elif status_code == -101:
-                process_status_101(user_counters, worker_id,
-                                   user_id, cost_time, workers)
-            else:
-                LOGGER.info("[%d/%d] <worker-%s> draw (%d, %d), status: %s, "
-                            "retry after %ds, cost %.2fs"
-                            % (index, total, worker_id, x, y,
-                               status_code, wait_time, cost_time))
-
-            # sleep for cool-down time
-            if wait_time > 0:
-                await asyncio.sleep(wait_time)
+async def draw_task(up, task_queue, total, user_counters, account, task):
+    """Dispatcher handler, return the DrawResult of the account, or None if
+    its cookie is invalid
+    """
+    worker_id = account.worker_id
+    index, x, y, color_code = task
+    result = DrawResult(0, None, None)
+    finished = False
+    try:
+        # check if it is already the correct color_code
+        if up.canvas.get_code(x, y) == color_code:
+            LOGGER.debug(
+                "[%d/%d] <worker-%s> skip correct pixel (%d, %d)" %
+                (index, total, worker_id, x, y))
+            finished = True
+            return result
+
+        # output may be an empty string
+        LOGGER.debug("<worker-%s> start to draw (%d, %d)" %
+                     (worker_id, x, y))
+
+        status_code, wait_time, cost_time = \
+            await async_draw_pixel_with_requests(account.session, x, y,
+                                                 color_code)
+        result = DrawResult(wait_time, cost_time, status_code)
+
+        if status_code == 0:
+            LOGGER.info(
+                "[%d/%d] <worker-%s> draw (%d, %d) with %s, status:"
+                " %d, cost %.2fs" %
+                (index, total, worker_id, x, y, color_code, status_code,
+                 cost_time))
+            finished = True
+        elif status_code == -101:
+            if process_status_101(user_counters, worker_id,
+                                  account.user_id, cost_time):
+                return None
+        else:
+            LOGGER.info("[%d/%d] <worker-%s> draw (%d, %d), status: %s, "
+                        "retry after %ds, cost %.2fs"
+                        % (index, total, worker_id, x, y,
+                           status_code, wait_time, cost_time))
+        return result
+    finally:
+        if not finished:
+            # the queue is ordered by index, the next ready account retries
+            # this pixel first
+            task_queue.put_nowait(task)
+        task_queue.task_done()
 
 
 def main():
-    if len(sys.argv) == 3:
-        tasks_filename = sys.argv[1]
-        user_filename = sys.argv[2]
-    else:
-        print("Usage: %s task_file user_file" % sys.argv[0])
-        sys.exit()
-
-    with open(tasks_filename, "r") as fp:
-        tasks = json.load(fp)
-
-    # convert missing colors to available colors, and convert RGB hex to
-    # one-character color code
-    tasks_dict = process_tasks(tasks)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('tasks_filename', metavar='task_file')
+    parser.add_argument('user_filename', metavar='user_file')
+    add_pool_arguments(parser)
+    add_mirror_argument(parser)
+    add_metrics_argument(parser)
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    tasks_filename = args.tasks_filename
+    user_filename = args.user_filename
+
+    tasks_dict, _ = load_tasks_dict(tasks_filename)
     total_task = len(tasks_dict)
     user_counters = collections.defaultdict(int)
     loop = asyncio.get_event_loop()
-    connector = aiohttp.TCPConnector(loop=loop)
-    # TODO: use PriorityQueue to have better control of tasks
-    task_queue = asyncio.Queue(loop=loop)
+    pool = ConnectionPool.from_args(args, loop=loop)
+    profiler = None
+    if args.profile:
+        profiler = Profiler(loop=loop, slow_callback=args.slow_callback)
+        profiler.start()
+    # ordered by index, so a failed pixel is retried before the others
+    task_queue = asyncio.PriorityQueue(loop=loop)
 
     for index, ((x, y), color_code) in enumerate(tasks_dict.items(), 1):
         task_queue.put_nowait((index, x, y, color_code))
@@ -96,26 +111,31 @@ def main():
             user_cookies = extract_cookies(user_cmd)
             session_list.append((
                 user_cookies,
-                aiohttp.ClientSession(
-                    connector=connector,
-                    loop=loop,
-                    cookies=user_cookies,
-                    connector_owner=False),
+                pool.create_session(user_cookies),
             ))
 
     LOGGER.critical('[INFO] loaded %d accounts' % len(session_list))
 
-    up = UpdateImage()
+    up = UpdateImage(mirror=args.mirror)
     loop.run_until_complete(up.perform_update_image())
     asyncio.ensure_future(up.start_websocket())
 
-    workers = [None] * len(session_list)
-    for worker_id, (user_cookies, session) in enumerate(session_list):
-        workers[worker_id] = asyncio.Task(
-            task_main(worker_id, user_cookies['DedeUserID'], session,
-                      task_queue, total_task, up, user_counters, workers),
-            loop=loop
-        )
+    accounts = [Account(worker_id, user_cookies['DedeUserID'], session)
+                for worker_id, (user_cookies, session)
+                in enumerate(session_list)]
+    dispatcher = Dispatcher(
+        accounts, task_queue,
+        functools.partial(draw_task, up, task_queue, total_task,
+                          user_counters),
+        loop=loop)
+    asyncio.ensure_future(dispatcher.run(), loop=loop)
+    asyncio.ensure_future(pool.keep_warm(dispatcher), loop=loop)
+    metrics_server = None
+    if args.metrics_port is not None:
+        metrics_server = MetricsServer(
+            Metrics(up, task_queue, dispatcher, pool), args.metrics_port,
+            loop=loop)
+        loop.run_until_complete(metrics_server.start())
 
     try:
         loop.run_until_complete(asyncio.ensure_future(task_queue.join()))
@@ -138,7 +158,13 @@ def main():
         except asyncio.CancelledError:
             pass
         up.close()
-        connector.close()
+        LOGGER.critical("connection pool: %s" % pool.summary())
+        if metrics_server is not None:
+            loop.run_until_complete(metrics_server.close())
+        if profiler is not None:
+            profiler.stop()
+            LOGGER.critical("profile:\n%s" % profiler.report())
+        loop.run_until_complete(pool.close())
         loop.stop()
         loop.close()
         sys.exit()
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""
+Local stand-in of the SummerDraw service for load testing, see
+load_test.py. Point the tools to it with
+
+    BDRAW_API_URL=http://127.0.0.1:8080/activity/v1/SummerDraw
+    BDRAW_WS_URL=ws://127.0.0.1:8080/sub
+
+It serves the draw endpoint with per-account cool-downs and -101 for
+invalid accounts, the bitmap endpoint, and the WebSocket broadcasting
+DRAW_UPDATE messages in batches. Adversarial painters keep polluting the
+pixels of a task file, and the time until each polluted pixel is repaired
+is measured. /stats returns the statistics as JSON.
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from aiohttp import web
+from canvas import Canvas
+from frame_parser import pack_message, DRAW_UPDATE_TEMPLATE
+from latency import LatencyTracker
+from task_file import load_tasks_dict
+from util import PALETTE_CODES, CODE_INDEX_TABLE
+import logger
+
+LOGGER = logger.get_logger('fake_server')
+
+API_PATH = "/activity/v1/SummerDraw"
+WEBSOCKET_PATH = "/sub"
+
+# palette index byte -> color code byte, for bytes.translate()
+INDEX_TO_CODE = (PALETTE_CODES.encode('ascii') +
+                 bytes(256 - len(PALETTE_CODES)))
+
+# cool-down rejection, the remaining seconds are in data.time
+STATUS_COOLING_DOWN = -400
+
+# seconds between WebSocket frames, the updates are batched in between
+FLUSH_INTERVAL = 0.05
+
+
+class FakeServer(object):
+    def __init__(self, *, cooldown=180, invalid_ratio=0.0, paint_rate=0.0,
+                 polluted_ratio=0.1, tasks_dict=None, seed=0):
+        self.cooldown = cooldown
+        self.invalid_ratio = invalid_ratio
+        self.paint_rate = paint_rate
+        self.rng = random.Random(seed)
+        self.canvas = Canvas()
+        # pixel index -> target color code, the pixels attacked by painters
+        self.targets = {}
+        # pixel index -> time it was polluted
+        self.polluted_at = {}
+        if tasks_dict is not None:
+            self.set_targets(tasks_dict, polluted_ratio)
+        # user id -> time when the cool-down ends
+        self.ready_at = {}
+        self.invalid_users = set()
+        self.valid_users = set()
+        self.clients = set()
+        self.pending = []
+
+        self.started = time.time()
+        self.draws = 0
+        self.cooling_rejects = 0
+        self.invalid_rejects = 0
+        self.painted = 0
+        self.repaired = 0
+        self.frames = 0
+        self.repair_latency = LatencyTracker()
+
+    def set_targets(self, tasks_dict, polluted_ratio):
+        now = time.time()
+        for (x, y), color_code in tasks_dict.items():
+            index = y * self.canvas.width + x
+            self.targets[index] = color_code
+            if self.rng.random() < polluted_ratio:
+                self.canvas.set_code(x, y, self.wrong_code(color_code))
+                self.polluted_at[index] = now
+            else:
+                self.canvas.set_code(x, y, color_code)
+
+    def wrong_code(self, color_code):
+        code = self.rng.choice(PALETTE_CODES)
+        while code == color_code:
+            code = self.rng.choice(PALETTE_CODES)
+        return code
+
+    def paint(self, x, y, color_code):
+        """change a pixel, track the pollution of the targets and broadcast
+        the update
+        """
+        index = y * self.canvas.width + x
+        self.canvas.set_code(x, y, color_code)
+        target = self.targets.get(index)
+        if target is not None:
+            if target != color_code:
+                self.polluted_at.setdefault(index, time.time())
+            elif index in self.polluted_at:
+                self.repaired += 1
+                self.repair_latency.observe(
+                    time.time() - self.polluted_at.pop(index))
+        self.pending.append((x, y, color_code))
+
+    def is_invalid(self, user_id):
+        if user_id is None:
+            return True
+        if user_id not in self.invalid_users and \
+                user_id not in self.valid_users:
+            if self.rng.random() < self.invalid_ratio:
+                self.invalid_users.add(user_id)
+            else:
+                self.valid_users.add(user_id)
+        return user_id in self.invalid_users
+
+    async def handle_draw(self, request):
+        user_id = request.cookies.get('DedeUserID')
+        if self.is_invalid(user_id):
+            self.invalid_rejects += 1
+            return web.json_response({"code": -101, "msg": "not logged in",
+                                      "data": {}})
+        now = time.time()
+        ready_at = self.ready_at.get(user_id, 0)
+        if now < ready_at:
+            self.cooling_rejects += 1
+            return web.json_response({"code": STATUS_COOLING_DOWN,
+                                      "msg": "cooling down",
+                                      "data": {"time": ready_at - now}})
+
+        form = await request.post()
+        try:
+            x = int(form['x_min'])
+            y = int(form['y_min'])
+            color_code = form['color']
+            CODE_INDEX_TABLE[color_code]
+            if not (0 <= x < self.canvas.width and
+                    0 <= y < self.canvas.height):
+                raise ValueError("(%d, %d) is out of the board" % (x, y))
+        except (KeyError, ValueError) as e:
+            return web.json_response({"code": -1, "msg": "bad request %s" % e,
+                                      "data": {}})
+        self.ready_at[user_id] = now + self.cooldown
+        self.draws += 1
+        self.paint(x, y, color_code)
+        return web.json_response({"code": 0, "msg": "success",
+                                  "data": {"time": self.cooldown}})
+
+    async def handle_bitmap(self, request):
+        bitmap = bytes(self.canvas.buffer).translate(INDEX_TO_CODE)
+        return web.json_response({"code": 0, "msg": "success",
+                                  "data": {"bitmap": bitmap.decode('ascii')}})
+
+    async def handle_warmup(self, request):
+        # without a body, so the client keeps the connection alive
+        return web.Response(status=204)
+
+    async def handle_stats(self, request):
+        return web.json_response(self.stats())
+
+    async def handle_websocket(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.clients.add(ws)
+        try:
+            # the token and heart beats of the clients are ignored
+            async for _ in ws:
+                pass
+        finally:
+            self.clients.discard(ws)
+        return ws
+
+    async def flush(self):
+        """send the pending updates to every client in one frame
+        """
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            if not self.pending:
+                continue
+            frame = b"".join(
+                pack_message((DRAW_UPDATE_TEMPLATE %
+                              (x, y, x, y, color_code)).encode('utf-8'))
+                for x, y, color_code in self.pending)
+            self.pending = []
+            self.frames += 1
+            for ws in list(self.clients):
+                try:
+                    await ws.send_bytes(frame)
+                except Exception as e:
+                    LOGGER.warning("failed to send frame: %s" % e)
+                    self.clients.discard(ws)
+
+    async def painters(self):
+        """pollute paint_rate random target pixels per second
+        """
+        targets = list(self.targets.items())
+        budget = 0.0
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            if not targets:
+                continue
+            budget += self.paint_rate * FLUSH_INTERVAL
+            while budget >= 1:
+                budget -= 1
+                index, color_code = self.rng.choice(targets)
+                x, y = index % self.canvas.width, index // self.canvas.width
+                self.painted += 1
+                self.paint(x, y, self.wrong_code(color_code))
+
+    def stats(self):
+        elapsed = time.time() - self.started
+        return {
+            "elapsed": elapsed,
+            "draws": self.draws,
+            "draws_per_second": self.draws / elapsed if elapsed else 0.0,
+            "cooling_rejects": self.cooling_rejects,
+            "invalid_rejects": self.invalid_rejects,
+            "painted": self.painted,
+            "repaired": self.repaired,
+            "polluted": len(self.polluted_at),
+            "targets": len(self.targets),
+            "frames": self.frames,
+            "clients": len(self.clients),
+            "repair_latency": {
+                "count": self.repair_latency.count,
+                "mean": (self.repair_latency.sum / self.repair_latency.count
+                         if self.repair_latency.count else None),
+                "p50": self.repair_latency.percentile(50),
+                "p90": self.repair_latency.percentile(90),
+                "p99": self.repair_latency.percentile(99),
+                "max": self.repair_latency.max,
+            },
+        }
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_post(API_PATH + "/draw", self.handle_draw)
+        app.router.add_get(API_PATH + "/bitmap", self.handle_bitmap)
+        app.router.add_get(WEBSOCKET_PATH, self.handle_websocket)
+        app.router.add_get("/stats", self.handle_stats)
+        # connection_pool warms connections up with HEAD requests
+        app.router.add_route("HEAD", "/", self.handle_warmup)
+        app.on_startup.append(self.on_startup)
+        return app
+
+    async def on_startup(self, app):
+        self.started = time.time()
+        asyncio.ensure_future(self.flush())
+        asyncio.ensure_future(self.painters())
+
+
+def add_server_arguments(parser):
+    group = parser.add_argument_group("stand-in server")
+    group.add_argument('--cooldown', type=float, default=180,
+                       help="seconds between the draws of an account")
+    group.add_argument('--invalid-ratio', type=float, default=0.0,
+                       help="ratio of accounts answered with -101")
+    group.add_argument('--paint-rate', type=float, default=0.0,
+                       help="pixels of the task file polluted per second")
+    group.add_argument('--polluted-ratio', type=float, default=0.1,
+                       help="ratio of the task file polluted at start")
+    group.add_argument('--seed', type=int, default=0)
+
+
+def create_server(args, tasks_filename=None):
+    tasks_dict = None
+    if tasks_filename is not None:
+        tasks_dict, _ = load_tasks_dict(tasks_filename)
+    return FakeServer(cooldown=args.cooldown,
+                      invalid_ratio=args.invalid_ratio,
+                      paint_rate=args.paint_rate,
+                      polluted_ratio=args.polluted_ratio,
+                      tasks_dict=tasks_dict, seed=args.seed)
+
+
+def run_server(args, host, port, tasks_filename=None):
+    server = create_server(args, tasks_filename)
+    # a new event loop, this may run in a child process
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    web.run_app(server.create_app(), host=host, port=port, print=None,
+                access_log=None, shutdown_timeout=1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--tasks', dest='tasks_filename', metavar='task_file',
+                        help="pixels attacked by the painters")
+    add_server_arguments(parser)
+    args = parser.parse_args()
+    print("Serving on http://%s:%d%s and ws://%s:%d%s" %
+          (args.host, args.port, API_PATH, args.host, args.port,
+           WEBSOCKET_PATH))
+    run_server(args, args.host, args.port, args.tasks_filename)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+import re
+import sys
+import json
+import struct
+import random
+import collections
+import logger
+from util import PALETTE_CODES
+
+__all__ = ["parse_frame", "parse_frame_slow", "read_corpus", "write_corpus",
+           "synthetic_frames"]
+
+LOGGER = logger.get_logger('frame_parser')
+
+"""
+Protocol:
+
+4 - JSON message end offset
+2 - JSON message start offset
+2 - unknown1
+4 - opcode
+    3 - something for online
+    5 - msg
+4 - unknown2, padding?
+"""
+message_header_struct = struct.Struct("!IHHI")
+MessageHeader = collections.namedtuple("MessageHeader",
+                                       [
+                                           "end_offset",
+                                           "start_offset",
+                                           "unknown1",
+                                           "opcode",
+                                       ])
+
+# the exact shape sent by the server, anything else goes through json.loads
+DRAW_UPDATE_PATTERN = re.compile(
+    rb'\{"cmd":"DRAW_UPDATE","data":\{'
+    rb'"x_min":(?:0|[1-9][0-9]*),"y_min":(?:0|[1-9][0-9]*),'
+    rb'"x_max":(0|[1-9][0-9]*),"y_max":(0|[1-9][0-9]*),'
+    rb'"color":"([0-9A-V])"\}\}')
+
+DRAW_UPDATE_TEMPLATE = ('{"cmd":"DRAW_UPDATE","data":{"x_min":%d,"y_min":%d,'
+                        '"x_max":%d,"y_max":%d,"color":"%s"}}')
+
+
+def parse_frame(message):
+    """return the (x, y, color_code) of every DRAW_UPDATE in a message frame,
+    and the decoded objects of other commands
+
+    DRAW_UPDATE messages are matched in place without slicing or decoding
+    JSON. Parsing stops at the first broken message, what has been parsed is
+    still returned.
+    """
+    updates = []
+    others = []
+    view = memoryview(message)
+    length = len(view)
+    unpack_from = message_header_struct.unpack_from
+    fullmatch = DRAW_UPDATE_PATTERN.fullmatch
+    offset = 0
+    while offset < length:
+        try:
+            end_offset, start_offset, _, _ = unpack_from(view, offset)
+            if end_offset <= 0:
+                raise ValueError("invalid end offset %d" % end_offset)
+            match = fullmatch(view, offset + start_offset, offset + end_offset)
+            if match is not None:
+                x, y, color_code = match.groups()
+                updates.append((int(x), int(y), chr(color_code[0])))
+            else:
+                parse_json(view[offset + start_offset:offset + end_offset],
+                           updates, others)
+            offset += end_offset
+        except Exception as err:
+            LOGGER.error("Error message (offset: %d): %s, err: %s" %
+                         (offset, bytes(view), err))
+            break
+    return updates, others
+
+
+def parse_json(data, updates, others):
+    message_object = json.loads(bytes(data))
+    if message_object['cmd'] == "DRAW_UPDATE":
+        updates.append((message_object['data']['x_max'],
+                        message_object['data']['y_max'],
+                        message_object['data']['color']))
+    else:
+        others.append(message_object)
+
+
+def parse_frame_slow(message):
+    """reference implementation of parse_frame which decodes every message
+    with json.loads, used for benchmarking and fuzzing
+    """
+    updates = []
+    others = []
+    offset = 0
+    while offset < len(message):
+        try:
+            message_header = MessageHeader._make(
+                message_header_struct.unpack_from(message, offset))
+            if message_header.end_offset <= 0:
+                raise ValueError("invalid end offset")
+            parse_json(message[offset + message_header.start_offset:
+                               offset + message_header.end_offset],
+                       updates, others)
+            offset += message_header.end_offset
+        except Exception:
+            break
+    return updates, others
+
+
+def pack_message(body, opcode=5):
+    header_size = message_header_struct.size + 4
+    return (message_header_struct.pack(header_size + len(body), header_size,
+                                       1, opcode) +
+            struct.pack("!I", 1) + body)
+
+
+def synthetic_frames(rng, count, max_updates=20, other_ratio=0.05):
+    """generate frames with the shape of the messages sent by the server, a
+    frame is a batch of DRAW_UPDATE messages, sometimes with other commands
+    """
+    for _ in range(count):
+        frame = bytearray()
+        for _ in range(rng.randint(1, max_updates)):
+            if rng.random() < other_ratio:
+                body = json.dumps({"cmd": "SYS_MSG",
+                                   "msg": "notice %d" % rng.randrange(1000)})
+            else:
+                x = rng.randrange(1280)
+                y = rng.randrange(720)
+                body = DRAW_UPDATE_TEMPLATE % (x, y, x, y,
+                                               rng.choice(PALETTE_CODES))
+            frame += pack_message(body.encode('utf-8'))
+        yield bytes(frame)
+
+
+def write_corpus(fp, message):
+    """append a frame to a corpus file, each frame is prefixed with its
+    length
+    """
+    fp.write(struct.pack("!I", len(message)))
+    fp.write(message)
+
+
+def read_corpus(filename):
+    frames = []
+    with open(filename, "rb") as fp:
+        data = fp.read()
+    offset = 0
+    while offset + 4 <= len(data):
+        size, = struct.unpack_from("!I", data, offset)
+        frames.append(data[offset + 4:offset + 4 + size])
+        offset += 4 + size
+    return frames
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: %s corpus_file number_of_frames" % sys.argv[0])
+        print("Generate a synthetic corpus of WebSocket frames, use "
+              "guard.py --record-frames to record a real one")
+        sys.exit()
+
+    with open(sys.argv[1], "wb") as fp:
+        for frame in synthetic_frames(random.Random(0), int(sys.argv[2])):
+            write_corpus(fp, frame)
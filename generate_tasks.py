@@ -3,8 +3,78 @@
 import json
 import argparse
 import sys
+import numpy as np
 from PIL import Image
-from util import rgb_to_hex
+from util import rgb_to_hex, hex_to_rgb, rgb_hex_to_color_code,\
+    CODE_INDEX_TABLE, load_palette_lut
+from task_file import TaskFile, BINARY_EXTENSION
+
+
+def generate_pattern_tasks(img_pattern, topleft, boundary):
+    """return x, y and packed RGB arrays of the non-transparent pixels of a
+    RGBA pattern image placed at topleft, in column-major order
+    """
+    width, height = img_pattern.size
+    x_boundary, y_boundary = boundary
+    x_base, y_base = topleft
+    assert x_base + width <= x_boundary and y_base + height <= y_boundary, \
+        "pattern image (%d,%d) is out of scope" % (width - 1, height - 1)
+
+    data = np.asarray(img_pattern).transpose(1, 0, 2)
+    # skip transparent pixels
+    xs, ys = np.nonzero(data[:, :, 3])
+    rgb = data[xs, ys, :3].astype(np.uint32)
+    packed = (rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2]
+    return xs + x_base, ys + y_base, packed
+
+
+def generate_rect_tasks(img_rgb, rect):
+    """return x, y and packed RGB arrays of a rectangle of the reference
+    image, in row-major order, raise ValueError if the rectangle is not
+    inside the image
+    """
+    start_x, start_y, end_x, end_y = rect
+    width, height = img_rgb.size
+    if not (0 <= start_x <= end_x < width and 0 <= start_y <= end_y < height):
+        raise ValueError("rectangle (%d, %d, %d, %d) is inverted or out of "
+                         "the %dx%d reference image" %
+                         (start_x, start_y, end_x, end_y, width, height))
+    data = np.asarray(img_rgb)[start_y:end_y + 1, start_x:end_x + 1]
+    ys, xs = np.indices(data.shape[:2])
+    rgb = data.reshape(-1, 3).astype(np.uint32)
+    packed = (rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2]
+    return xs.ravel() + start_x, ys.ravel() + start_y, packed
+
+
+def color_index(rgb_hex):
+    """palette index of a color, fall back to the nearest available color
+    when it is not a known missing color
+    """
+    try:
+        return CODE_INDEX_TABLE[rgb_hex_to_color_code(rgb_hex)]
+    except (ValueError, KeyError):
+        r, g, b = hex_to_rgb(rgb_hex)
+        return int(load_palette_lut()[(r << 16) | (g << 8) | b])
+
+
+def write_tasks(filename, xs, ys, packed, size):
+    """write the tasks as JSON, or in binary format if filename ends with .bin
+    """
+    colors, inverse = np.unique(packed, return_inverse=True)
+    hexes = [rgb_to_hex(c >> 16, (c >> 8) & 0xff, c & 0xff)
+             for c in colors.tolist()]
+
+    if filename.endswith(BINARY_EXTENSION):
+        color_codes = np.array([color_index(rgb_hex) for rgb_hex in hexes],
+                               dtype=np.uint8)
+        width, height = size
+        TaskFile.from_arrays(ys * width + xs, color_codes[inverse],
+                             width, height).save(filename)
+    else:
+        tasks = [[x, y, hexes[i]] for x, y, i in
+                 zip(xs.tolist(), ys.tolist(), inverse.tolist())]
+        with open(filename, "w") as fp:
+            json.dump(tasks, fp)
 
 
 if __name__ == "__main__":
@@ -23,46 +93,31 @@ if __name__ == "__main__":
 
     img = Image.open(args.reference_filename)
     img_rgb = img.convert('RGB')
-    m, n = img.size
 
-    tasks = []
+    parts = []
     if args.pattern_filename is not None:
         assert args.topleft is not None, "--topleft parameter is missing"
         img_pattern = Image.open(args.pattern_filename)
         if img_pattern.mode != 'RGBA':
             img_pattern = img_pattern.convert("RGBA")
-        # img_rgb.paste(img_pattern, args.topleft, img_pattern)
-        width, height = img_pattern.size
-        x_boundary, y_boundary = img_rgb.size
-        x_base, y_base = args.topleft
-        for x in range(width):
-            for y in range(height):
-                assert x_base + x < x_boundary, \
-                    "pattern image (%d,%d) is out of scope" % (x, y)
-                assert y_base + y < y_boundary, \
-                    "pattern image (%d,%d) is out of scope" % (x, y)
-                r, g, b, a = img_pattern.getpixel((x, y))
-                # skip transparent pixels
-                if a == 0:
-                    continue
-                tasks.append((x + x_base, y + y_base, rgb_to_hex(r, g, b)))
+        parts.append(generate_pattern_tasks(img_pattern, args.topleft,
+                                            img_rgb.size))
 
     if args.rect is not None:
-        start_x, start_y, end_x, end_y = args.rect
-        for y in range(start_y, end_y + 1):
-            for x in range(start_x, end_x + 1):
-                r, g, b = img_rgb.getpixel((x, y))
-                # print(x, y, rgb_to_hex(r, g, b))
-                tasks.append((x, y, rgb_to_hex(r, g, b)))
-
-    if not tasks:
+        try:
+            parts.append(generate_rect_tasks(img_rgb, args.rect))
+        except ValueError as e:
+            parser.error(str(e))
+
+    if parts:
+        xs, ys, packed = (np.concatenate(arrays) for arrays in zip(*parts))
+    if not parts or len(xs) == 0:
         print("No task was generated")
         sys.exit()
 
     try:
-        with open(args.output_filename, "w") as fp:
-            json.dump(tasks, fp)
-        print("Write %d tasks to %s" % (len(tasks), args.output_filename))
+        write_tasks(args.output_filename, xs, ys, packed, img_rgb.size)
+        print("Write %d tasks to %s" % (len(xs), args.output_filename))
     except IOError as e:
-        print("Failed to write tasks to %s, with error: " %
+        print("Failed to write tasks to %s, with error: %s" %
               (args.output_filename, e))
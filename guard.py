@@ -1,14 +1,21 @@
 #!/usr/bin/env python3
 
-import json
 import functools
 import sys
+import argparse
 import asyncio
 import collections
-import aiohttp
+from account_store import AccountStore, add_account_store_argument
+from canvas_mirror import add_mirror_argument
+from connection_pool import ConnectionPool, add_pool_arguments
+from metrics import Metrics, MetricsServer, add_metrics_argument
+from profiling import Profiler, add_profile_arguments
 from update_image import UpdateImage
-from util import process_tasks, RGB_CODE_TABLE, CODE_RGB_TABLE,\
-    async_draw_pixel_with_requests, extract_cookies, process_status_101
+from pixel_queue import PixelQueue
+from scheduler import Account, Dispatcher, DrawResult
+from util import async_draw_pixel_with_requests, extract_cookies,\
+    process_status_101
+from task_file import load_tasks_dict
 import logger
 
 LOGGER = logger.get_logger('guard')
@@ -18,95 +25,133 @@ def get_task_priority(priority_dict, x, y, default_priority=0):
     return priority_dict.get((x, y), default_priority)
 
 
-def find_all_polluted_pixels(tasks_dict, priority_dict, up):
-    """This method will be called inside critical section
+async def repair_pixel(up, task_queue, user_counters, account, task):
+    """Dispatcher handler, return the DrawResult of the account, or None if
+    its cookie is invalid
     """
-    default_priority = 0
-    polluted_tasks = []
-    for (x, y), color_code in tasks_dict.items():
-        rgb = CODE_RGB_TABLE[color_code]
-        if rgb != up.get_image_pixel(x, y):
-            priority = get_task_priority(priority_dict, x, y, default_priority)
-            polluted_tasks.append((priority, x, y, color_code))
-    return polluted_tasks
-
-
-async def task_main(worker_id, user_id, session, task_queue, up,
-                    user_counters, workers):
-    LOGGER.info("<worker-%s> start working" % worker_id)
-    wait_time = -1
-    while True:
-        priority, x, y, color_code = await task_queue.get()
-        while True:
-            success_flag = False
-            # check if it is already the correct color_code
-            current_rgb = up.get_image_pixel(x, y)
-            current_color_code = RGB_CODE_TABLE[current_rgb]
-            wait_time = -1
-            if current_color_code == color_code:
-                LOGGER.debug("<worker-%s> skip correct pixel (%d, %d)" %
-                             (worker_id, x, y))
-                break
-
-            # output may be an empty string
-            LOGGER.debug("<worker-%s> start to draw (%d, %d)" %
+    worker_id = account.worker_id
+    priority, x, y, color_code = task
+    result = DrawResult(0, None, None)
+    finished = False
+    try:
+        # check if it is already the correct color_code
+        if up.canvas.get_code(x, y) == color_code:
+            LOGGER.debug("<worker-%s> skip correct pixel (%d, %d)" %
                          (worker_id, x, y))
-
-            status_code, wait_time, cost_time = \
-                await async_draw_pixel_with_requests(session, x, y, color_code)
-
-            if status_code == 0:
-                LOGGER.info(
-                    "<worker-%s> draw (%d, %d) pri:%s with %s, "
-                    "status: %d, cost %.2fs" %
-                    (worker_id,
-                     x, y, priority, color_code, status_code, cost_time))
-
-                success_flag = True
-            elif status_code == -101:
-                process_status_101(user_counters, worker_id,
-                                   user_id, cost_time, workers)
-            else:
-                LOGGER.info(
-                    "<worker-%s> draw (%d, %d) pri:%s, status: %s, "
-                    "retry after %ds, cost %.2fs"
-                    % (worker_id, x, y, priority,
-                       status_code, wait_time, cost_time))
-
-            # sleep for cool-down time
-            if wait_time > 0:
-                await asyncio.sleep(wait_time)
-                if success_flag:
-                    break
+            finished = True
+            return result
+
+        # output may be an empty string
+        LOGGER.debug("<worker-%s> start to draw (%d, %d)" %
+                     (worker_id, x, y))
+
+        status_code, wait_time, cost_time = \
+            await async_draw_pixel_with_requests(account.session, x, y,
+                                                 color_code)
+        result = DrawResult(wait_time, cost_time, status_code)
+
+        if status_code == 0:
+            LOGGER.info(
+                "<worker-%s> draw (%d, %d) pri:%s with %s, "
+                "status: %d, cost %.2fs" %
+                (worker_id,
+                 x, y, priority, color_code, status_code, cost_time))
+
+            finished = True
+            if up.tracker is not None:
+                up.tracker.mark_drawn(x, y)
+        elif status_code == -101:
+            if process_status_101(user_counters, worker_id,
+                                  account.user_id, cost_time):
+                return None
+        else:
+            LOGGER.info(
+                "<worker-%s> draw (%d, %d) pri:%s, status: %s, "
+                "retry after %ds, cost %.2fs"
+                % (worker_id, x, y, priority,
+                   status_code, wait_time, cost_time))
+        return result
+    finally:
+        if not finished:
+            # give the pixel back to other accounts, e.g., the draw failed
+            # or the account is retired
+            task_queue.put_nowait((priority, x, y, color_code))
+        # the pixel is released before the cool-down, so that another
+        # account can repair it if it is polluted again
+        task_queue.release(x, y)
 
 
-def main():
-    if len(sys.argv) == 3:
-        tasks_filename = sys.argv[1]
-        user_filename = sys.argv[2]
-    else:
-        print("Usage: %s task_file user_file" % sys.argv[0])
-        sys.exit()
+def read_user_cmds(user_filename):
+    """return the curl command of every account in the user file
+    """
+    with open(user_filename, "r") as fp:
+        user_cmds = [user_cmd.strip() for user_cmd in fp
+                     # Skip comments
+                     if not user_cmd.startswith('#')]
+    # Skip empty line
+    return [user_cmd for user_cmd in user_cmds if user_cmd]
+
+
+def load_sessions(user_filename, pool, shard=0, shards=1, store=None):
+    """return (user_cookies, session) of every account in the user file,
+    only every shards-th account starting from shard is loaded, and the
+    accounts with cookies known to be invalid by the AccountStore are
+    skipped
+    """
+    session_list = []
+    user_cmds = read_user_cmds(user_filename)
+    skipped = 0
+    for user_cmd in user_cmds[shard::shards]:
+        user_cookies = extract_cookies(user_cmd)
+        if store is not None and not store.register(
+                user_cookies['DedeUserID'], user_cookies).valid:
+            skipped += 1
+            continue
+        session_list.append((
+            user_cookies,
+            pool.create_session(user_cookies),
+        ))
+    if skipped:
+        LOGGER.critical("skip %d accounts with invalid cookies" % skipped)
+    return session_list
 
-    with open(tasks_filename, "r") as fp:
-        tasks = json.load(fp)
 
-    # convert missing colors to available colors, and convert RGB hex to
-    # one-character color code
-    tasks_dict = process_tasks(tasks)
-    priority_dict = {}
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('tasks_filename', metavar='task_file')
+    parser.add_argument('user_filename', metavar='user_file')
+    add_pool_arguments(parser)
+    add_mirror_argument(parser)
+    add_metrics_argument(parser)
+    add_profile_arguments(parser)
+    add_account_store_argument(parser)
+    parser.add_argument('--record-frames', metavar='file',
+                        help="record every WebSocket frame into a corpus "
+                        "file, for benchmark.py --corpus")
+    args = parser.parse_args()
+    tasks_filename = args.tasks_filename
+    user_filename = args.user_filename
+
+    tasks_dict, priority_dict = load_tasks_dict(tasks_filename)
     user_counters = collections.defaultdict(int)
     loop = asyncio.get_event_loop()
-    connector = aiohttp.TCPConnector(loop=loop)
-    # TODO: use PriorityQueue to have better control of tasks
-    # task_queue = asyncio.Queue(loop=loop)
-    task_queue = asyncio.PriorityQueue(loop=loop)
+    pool = ConnectionPool.from_args(args, loop=loop)
+    profiler = None
+    if args.profile:
+        profiler = Profiler(loop=loop, slow_callback=args.slow_callback)
+        profiler.start()
+    connector = pool.connector
+    # one entry and one worker at most for every pixel
+    task_queue = PixelQueue(loop=loop)
 
     # enable reactive guard
     up = UpdateImage(task_queue=task_queue, guard_region=tasks_dict,
-                     loop=loop, connector=connector)
+                     guard_priority=priority_dict, loop=loop,
+                     connector=connector, mirror=args.mirror)
     up.full_update_callback = functools.partial(
         populate_tasks, tasks_dict, priority_dict, up, task_queue)
+    if args.record_frames is not None:
+        up.frame_corpus = open(args.record_frames, "wb")
 
     # Load plugin clock
     # import clock
@@ -114,26 +159,10 @@ def main():
     #    loop, tasks_dict, priority_dict, up, task_queue)
     # clock_plugin.enable()
 
-    session_list = []
-    with open(user_filename, "r") as fp:
-        for user_cmd in fp:
-            # Skip comments
-            if user_cmd.startswith('#'):
-                continue
-            # Skip empty line
-            user_cmd = user_cmd.strip()
-            if not user_cmd:
-                continue
-            user_cookies = extract_cookies(user_cmd)
-            session_list.append((
-                user_cookies,
-                aiohttp.ClientSession(
-                    connector=connector,
-                    loop=loop,
-                    cookies=user_cookies,
-                    connector_owner=False),
-            ))
-
+    store = None
+    if args.account_store is not None:
+        store = AccountStore(args.account_store)
+    session_list = load_sessions(user_filename, pool, store=store)
     LOGGER.critical('loaded %d accounts' % len(session_list))
 
     loop.run_until_complete(up.perform_update_image())
@@ -141,13 +170,30 @@ def main():
     # websocket_task = asyncio.ensure_future(up.start_websocket())
     asyncio.ensure_future(up.start_websocket())
 
-    workers = [None] * len(session_list)
-    for worker_id, (user_cookies, session) in enumerate(session_list):
-        workers[worker_id] = asyncio.Task(
-            task_main(worker_id, user_cookies['DedeUserID'], session,
-                      task_queue, up, user_counters, workers),
-            loop=loop
-        )
+    accounts = [Account(worker_id, user_cookies['DedeUserID'], session)
+                for worker_id, (user_cookies, session)
+                in enumerate(session_list)]
+    handler = functools.partial(repair_pixel, up, task_queue, user_counters)
+    if store is not None:
+        # -101 responses before the restart count towards retiring
+        user_counters.update(store.failures())
+        handler = store.track(handler)
+        asyncio.ensure_future(store.keep_saved(loop), loop=loop)
+    dispatcher = Dispatcher([], task_queue, handler, loop=loop)
+    for account in accounts:
+        # resume the cool-downs of the previous run
+        wait_time = 0
+        if store is not None:
+            wait_time = store.wait_time(account.user_id)
+        dispatcher.add(account, wait_time=wait_time)
+    asyncio.ensure_future(dispatcher.run(), loop=loop)
+    asyncio.ensure_future(pool.keep_warm(dispatcher), loop=loop)
+    metrics_server = None
+    if args.metrics_port is not None:
+        metrics_server = MetricsServer(
+            Metrics(up, task_queue, dispatcher, pool), args.metrics_port,
+            loop=loop)
+        loop.run_until_complete(metrics_server.start())
 
     try:
         loop.run_forever()
@@ -167,18 +213,33 @@ def main():
         # to give the event loop a chance to finish this.
         loop.run_until_complete(asyncio.gather(*all_tasks))
     finally:
-        connector.close()
+        LOGGER.critical("connection pool: %s" % pool.summary())
+        if metrics_server is not None:
+            loop.run_until_complete(metrics_server.close())
+        if profiler is not None:
+            profiler.stop()
+            LOGGER.critical("profile:\n%s" % profiler.report())
+        if store is not None:
+            store.close()
+        if up.frame_corpus is not None:
+            up.frame_corpus.close()
+        loop.run_until_complete(pool.close())
         loop.stop()
         loop.close()
         sys.exit()
 
 
 def populate_tasks(tasks_dict, priority_dict, up, task_queue):
-    find_func = functools.partial(
-        find_all_polluted_pixels, tasks_dict, priority_dict)
-    polluted_pixels = up.get_task(find_func)
-    for task in polluted_pixels:
-        task_queue.put_nowait(task)
+    """Called after every full update, only queue the pixels that were not
+    already known to be polluted
+    """
+    tracker = up.tracker
+    for x, y in tracker.rescan():
+        task_queue.put_nowait(
+            (get_task_priority(priority_dict, x, y), x, y, tasks_dict[(x, y)])
+        )
+    LOGGER.info("%d/%d pixels polluted, %.2f%% complete" %
+                (tracker.polluted_count, tracker.total, tracker.progress))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+Append-only journal of the sketch board. Every DRAW_UPDATE received from
+the WebSocket is appended as a delta, and a zlib-compressed keyframe of the
+whole board is appended after every full update and periodically, so the
+board at any instant is rebuilt from the last keyframe before it plus the
+following deltas.
+
+Journal file:
+
+8 - magic "BDJRNL1\\0"
+2 - width
+2 - height
+followed by records, all timestamps are seconds since the epoch:
+
+"D" record, the updates of one message
+1 - "D"
+8 - (double) timestamp
+2 - number of updates
+5 * number of updates - x (2), y (2) and palette index (1)
+
+"K" record, a keyframe
+1 - "K"
+8 - (double) timestamp
+4 - length of the compressed board
+length - zlib-compressed palette index of every pixel
+
+Index file, the journal filename with the ".index" suffix, one entry for
+every keyframe:
+8 - (double) timestamp
+8 - offset of the keyframe in the journal
+"""
+
+import argparse
+import bisect
+import os
+import struct
+import time
+import zlib
+from datetime import datetime
+from canvas import Canvas
+from util import PALETTE_CODES, CODE_INDEX_TABLE
+import logger
+
+__all__ = ["JournalWriter", "JournalReader"]
+
+LOGGER = logger.get_logger('journal')
+
+MAGIC = b"BDJRNL1\0"
+INDEX_SUFFIX = ".index"
+
+header_struct = struct.Struct("<8sHH")
+# kind and timestamp, followed by the number of updates of a delta, or the
+# length of a keyframe
+record_struct = struct.Struct("<cd")
+count_struct = struct.Struct("<H")
+length_struct = struct.Struct("<I")
+update_struct = struct.Struct("<HHB")
+index_struct = struct.Struct("<dQ")
+
+KIND_DELTA = b"D"
+KIND_KEYFRAME = b"K"
+
+
+def complete_end(fp, offset):
+    """return the offset after the last complete record from the record at
+    offset, the records aren't decoded
+    """
+    size = os.fstat(fp.fileno()).st_size
+    fp.seek(offset)
+    while True:
+        head = fp.read(record_struct.size)
+        if len(head) < record_struct.size:
+            return offset
+        kind, _ = record_struct.unpack(head)
+        if kind == KIND_DELTA:
+            head = fp.read(count_struct.size)
+            if len(head) < count_struct.size:
+                return offset
+            length = count_struct.unpack(head)[0] * update_struct.size
+        elif kind == KIND_KEYFRAME:
+            head = fp.read(length_struct.size)
+            if len(head) < length_struct.size:
+                return offset
+            length = length_struct.unpack(head)[0]
+        else:
+            return offset
+        if fp.tell() + length > size:
+            return offset
+        offset = fp.seek(length, os.SEEK_CUR)
+
+
+class JournalWriter(object):
+    """Append the changes of the canvas to a journal, keyframes are written
+    by write_keyframe() and at least every keyframe_interval seconds
+
+    Use write_updates as UpdateImage.update_callback and write_keyframe as
+    UpdateImage.full_update_callback.
+    """
+
+    def __init__(self, filename, canvas, keyframe_interval=600):
+        self.filename = filename
+        self.canvas = canvas
+        self.keyframe_interval = keyframe_interval
+        self.last_keyframe = None
+        self.updates = 0
+        self.keyframes = 0
+
+        exists = (os.path.exists(filename) and
+                  os.path.getsize(filename) >= header_struct.size)
+        if exists:
+            self._recover()
+        self.fp = open(filename, "ab" if exists else "wb")
+        if not exists:
+            self.fp.write(header_struct.pack(MAGIC, canvas.width,
+                                             canvas.height))
+        self.index_fp = open(filename + INDEX_SUFFIX, "ab" if exists else "wb")
+
+    def _recover(self):
+        """truncate the journal after its last complete record and the index
+        after its last complete entry pointing before it, so a record cut
+        short by a crash doesn't misalign the records appended after it
+        """
+        index_filename = self.filename + INDEX_SUFFIX
+        offsets = []
+        if os.path.exists(index_filename):
+            with open(index_filename, "rb") as fp:
+                data = fp.read()
+            data = data[:len(data) - len(data) % index_struct.size]
+            offsets = [offset for _, offset in index_struct.iter_unpack(data)]
+        with open(self.filename, "r+b") as fp:
+            magic, width, height = header_struct.unpack(
+                fp.read(header_struct.size))
+            if magic != MAGIC or (width, height) != (self.canvas.width,
+                                                     self.canvas.height):
+                raise ValueError("%s is not a journal of this board" %
+                                 self.filename)
+            size = os.fstat(fp.fileno()).st_size
+            # the records from the last keyframe in the index are checked
+            start = header_struct.size
+            for offset in reversed(offsets):
+                if offset < size:
+                    start = offset
+                    break
+            end = complete_end(fp, start)
+            if end < size:
+                LOGGER.warning("truncate %d bytes of incomplete records at "
+                               "the end of %s" % (size - end, self.filename))
+                fp.truncate(end)
+        entries = len([offset for offset in offsets if offset < end])
+        with open(index_filename, "ab") as fp:
+            fp.truncate(entries * index_struct.size)
+
+    def write_updates(self, update_list, timestamp=None):
+        if not update_list:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        data = bytearray(record_struct.pack(KIND_DELTA, timestamp))
+        data += count_struct.pack(len(update_list))
+        for x, y, color_code in update_list:
+            data += update_struct.pack(x, y, CODE_INDEX_TABLE[color_code])
+        self.fp.write(data)
+        self.updates += len(update_list)
+
+        if (self.last_keyframe is None or
+                timestamp - self.last_keyframe >= self.keyframe_interval):
+            self.write_keyframe(timestamp)
+
+    def write_keyframe(self, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        data = zlib.compress(bytes(self.canvas.buffer))
+        offset = self.fp.tell()
+        self.fp.write(record_struct.pack(KIND_KEYFRAME, timestamp))
+        self.fp.write(length_struct.pack(len(data)))
+        self.fp.write(data)
+        # the keyframe must be on disk before the index points to it
+        self.fp.flush()
+        self.index_fp.write(index_struct.pack(timestamp, offset))
+        self.index_fp.flush()
+        self.last_keyframe = timestamp
+        self.keyframes += 1
+        LOGGER.debug("keyframe at %.2f, %d bytes" % (timestamp, len(data)))
+
+    def flush(self):
+        self.fp.flush()
+        self.index_fp.flush()
+
+    def close(self):
+        self.fp.close()
+        self.index_fp.close()
+
+
+class JournalReader(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.fp = open(filename, "rb")
+        magic, self.width, self.height = header_struct.unpack(
+            self.fp.read(header_struct.size))
+        if magic != MAGIC:
+            raise ValueError("%s is not a journal" % filename)
+        self.timestamps = []
+        self.offsets = []
+        with open(filename + INDEX_SUFFIX, "rb") as fp:
+            data = fp.read()
+        # ignore an entry partially written by a crashed writer
+        data = data[:len(data) - len(data) % index_struct.size]
+        for timestamp, offset in index_struct.iter_unpack(data):
+            self.timestamps.append(timestamp)
+            self.offsets.append(offset)
+
+    def records(self, offset=header_struct.size):
+        """yield (timestamp, kind, payload) from offset, the payload is the
+        list of (x, y, color_code) of a delta, or the board of a keyframe
+        """
+        fp = self.fp
+        fp.seek(offset)
+        while True:
+            head = fp.read(record_struct.size)
+            if len(head) < record_struct.size:
+                return
+            kind, timestamp = record_struct.unpack(head)
+            if kind == KIND_DELTA:
+                head = fp.read(count_struct.size)
+                if len(head) < count_struct.size:
+                    return
+                size = count_struct.unpack(head)[0] * update_struct.size
+                data = fp.read(size)
+                if len(data) < size:
+                    return
+                yield timestamp, kind, [
+                    (x, y, PALETTE_CODES[index]) for x, y, index
+                    in update_struct.iter_unpack(data)]
+            elif kind == KIND_KEYFRAME:
+                head = fp.read(length_struct.size)
+                if len(head) < length_struct.size:
+                    return
+                size = length_struct.unpack(head)[0]
+                data = fp.read(size)
+                if len(data) < size:
+                    return
+                yield timestamp, kind, data
+            else:
+                raise ValueError("corrupted journal %s at offset %d" %
+                                 (self.filename, fp.tell()))
+
+    def board_at(self, timestamp):
+        """return the Canvas at the given timestamp, None if it is before the
+        first keyframe
+        """
+        i = bisect.bisect_right(self.timestamps, timestamp) - 1
+        if i < 0:
+            return None
+        canvas = None
+        for record_time, kind, payload in self.records(self.offsets[i]):
+            if record_time > timestamp:
+                break
+            if kind == KIND_KEYFRAME:
+                canvas = Canvas(self.width, self.height,
+                                bytearray(zlib.decompress(payload)))
+            else:
+                for x, y, color_code in payload:
+                    canvas.set_code(x, y, color_code)
+        return canvas
+
+    def close(self):
+        self.fp.close()
+
+
+def parse_time(text):
+    try:
+        return float(text)
+    except ValueError:
+        return time.mktime(
+            datetime.strptime(text, "%Y-%m-%d %H:%M:%S").timetuple())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="save the sketch board at a given time from a journal")
+    parser.add_argument('journal_filename', metavar='journal_file')
+    parser.add_argument('time', help="seconds since the epoch or local "
+                        "time as \"%%Y-%%m-%%d %%H:%%M:%%S\"")
+    parser.add_argument('output_filename', metavar='output_file')
+    args = parser.parse_args()
+
+    reader = JournalReader(args.journal_filename)
+    canvas = reader.board_at(parse_time(args.time))
+    reader.close()
+    if canvas is None:
+        parser.error("no keyframe before %s" % args.time)
+    canvas.to_image().save(args.output_filename)
+    print("Save picture to %s" % args.output_filename)
+
+
+if __name__ == "__main__":
+    main()
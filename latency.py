@@ -0,0 +1,56 @@
+import bisect
+
+__all__ = ["LatencyTracker", "BUCKETS", "LAG_BUCKETS"]
+
+# upper bounds of the histogram buckets in seconds
+BUCKETS = (0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5,
+           2.0, 3.0, 5.0, 10.0, 30.0, 60.0)
+# finer buckets for event loop lag
+LAG_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+               0.5, 1.0)
+
+
+class LatencyTracker(object):
+    """EWMA and fixed-bucket histogram of request round-trip times
+    """
+
+    def __init__(self, alpha=0.2, buckets=BUCKETS):
+        self.alpha = alpha
+        self.buckets = buckets
+        self.ewma = None
+        # the last bucket counts everything above buckets[-1]
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        if self.ewma is None:
+            self.ewma = value
+        else:
+            self.ewma += self.alpha * (value - self.ewma)
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, percent):
+        """upper bound of the bucket holding the given percentile, at most
+        the largest observation, None if nothing is observed
+        """
+        if self.count == 0:
+            return None
+        rank = self.count * percent / 100.0
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        if self.count == 0:
+            return "no samples"
+        return "ewma %.3fs, p50 %.3fs, p90 %.3fs, p99 %.3fs, %d samples" % (
+            self.ewma, self.percentile(50), self.percentile(90),
+            self.percentile(99), self.count)
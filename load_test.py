@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Run guard.py or draw_pixel.py in this process against the stand-in server
+of fake_server.py running in a child process, with synthetic accounts and
+tasks, then report the throughput, the repair latency measured by the
+server and the event loop lag of the tool.
+
+    python load_test.py --accounts 2000 --cooldown 10 --paint-rate 50
+
+Arguments not recognized here are passed to the tool, e.g., --limit 200.
+"""
+
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+import urllib.request
+from latency import LatencyTracker, LAG_BUCKETS
+from profiling import probe_loop_lag
+import logger
+
+# util reads the server URLs from the environment when it is imported, so
+# the modules importing util are imported after setting them, see main()
+HOST = "127.0.0.1"
+API_PATH = "/activity/v1/SummerDraw"
+WEBSOCKET_PATH = "/sub"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection((HOST, port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("the stand-in server didn't start in %ds" % timeout)
+
+
+def write_accounts(filename, count):
+    """write count accounts in the format of the user file, a curl command
+    with cookies per line
+    """
+    with open(filename, "w") as fp:
+        for user_id in range(1, count + 1):
+            fp.write("curl '%s/draw' -H 'Cookie: DedeUserID=%d; "
+                     "SESSDATA=load%d' --data 'x_min=0'\n" %
+                     (API_PATH, user_id, user_id))
+
+
+def write_tasks(filename, count, rng):
+    """write count tasks of random colors filling rows from (100, 100)
+    """
+    from task_file import save_tasks
+    from util import COLOR_CODE_TABLE
+    colors = sorted(COLOR_CODE_TABLE)
+    width = 1000
+    tasks = [(100 + i % width, 100 + i // width, rng.choice(colors))
+             for i in range(count)]
+    save_tasks(filename, tasks)
+
+
+def stop_tool():
+    # the tools exit cleanly on Ctrl-c
+    raise KeyboardInterrupt
+
+
+def fetch_stats(port):
+    url = "http://%s:%d/stats" % (HOST, port)
+    with urllib.request.urlopen(url, timeout=10) as r:
+        return json.loads(r.read().decode('utf-8'))
+
+
+def format_seconds(value):
+    return "-" if value is None else "%.3fs" % value
+
+
+def report(stats, lag, accounts, duration):
+    latency = stats["repair_latency"]
+    print("==== load test: %d accounts, %.0fs ====" % (accounts, duration))
+    print("draws: %d, %.2f pixels/s, %d cool-down rejections, %d -101" %
+          (stats["draws"], stats["draws_per_second"],
+           stats["cooling_rejects"], stats["invalid_rejects"]))
+    print("painters: %d polluted, %d repaired, %d/%d still polluted" %
+          (stats["painted"], stats["repaired"], stats["polluted"],
+           stats["targets"]))
+    print("repair latency: mean %s, p50 %s, p90 %s, p99 %s, max %s" %
+          tuple(format_seconds(latency[key])
+                for key in ("mean", "p50", "p90", "p99", "max")))
+    print("event loop lag: mean %s, p50 %s, p99 %s, max %s, %d samples" %
+          (format_seconds(lag.sum / lag.count if lag.count else None),
+           format_seconds(lag.percentile(50)),
+           format_seconds(lag.percentile(99)), format_seconds(lag.max),
+           lag.count))
+
+
+def main():
+    port = free_port()
+    os.environ["BDRAW_API_URL"] = "http://%s:%d%s" % (HOST, port, API_PATH)
+    os.environ["BDRAW_WS_URL"] = "ws://%s:%d%s" % (HOST, port,
+                                                   WEBSOCKET_PATH)
+    from fake_server import add_server_arguments
+
+    parser = argparse.ArgumentParser(
+        epilog="other arguments are passed to the tool")
+    parser.add_argument('--tool', choices=['guard', 'draw_pixel'],
+                        default='guard')
+    parser.add_argument('--accounts', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=60,
+                        help="seconds to run the tool")
+    parser.add_argument('--pixels', type=int, default=20000,
+                        help="number of synthetic tasks")
+    parser.add_argument('--tasks', dest='tasks_filename', metavar='task_file',
+                        help="use this task file instead of synthetic tasks")
+    parser.add_argument('--verbose', action='store_true',
+                        help="keep the INFO logs of the tool")
+    add_server_arguments(parser)
+    parser.set_defaults(cooldown=10, paint_rate=20)
+    args, tool_args = parser.parse_known_args()
+
+    with tempfile.TemporaryDirectory(prefix="bdraw_load_") as workdir:
+        run_load_test(args, tool_args, port, workdir)
+
+
+def run_load_test(args, tool_args, port, workdir):
+    """run the tool with the accounts and tasks written into workdir
+    """
+    from fake_server import run_server
+
+    rng = random.Random(args.seed)
+    user_filename = os.path.join(workdir, "users.txt")
+    write_accounts(user_filename, args.accounts)
+    tasks_filename = args.tasks_filename
+    if tasks_filename is None:
+        tasks_filename = os.path.join(workdir, "tasks.bin")
+        write_tasks(tasks_filename, args.pixels, rng)
+
+    server = multiprocessing.Process(
+        target=run_server, args=(args, HOST, port, tasks_filename),
+        daemon=True)
+    server.start()
+    wait_for_port(port)
+
+    tool = importlib.import_module(args.tool)
+    if not args.verbose:
+        logger.set_logger_level(logging.WARNING)
+
+    loop = asyncio.get_event_loop()
+    lag = LatencyTracker(buckets=LAG_BUCKETS)
+    asyncio.ensure_future(probe_loop_lag(loop, lag), loop=loop)
+    loop.call_later(args.duration, stop_tool)
+    sys.argv = [tool.__file__, tasks_filename, user_filename] + tool_args
+    start_time = time.time()
+    try:
+        tool.main()
+    except SystemExit:
+        pass
+    duration = time.time() - start_time
+
+    try:
+        report(fetch_stats(port), lag, args.accounts, duration)
+    finally:
+        server.terminate()
+        server.join(5)
+        if server.is_alive():
+            server.kill()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,85 +1,116 @@
 #!/usr/bin/env python3
 
-import json
 import argparse
 import random
 import collections
+from task_file import load_tasks, save_tasks, is_binary_task_file
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument('-f', dest='files', nargs='+', required=True)
-    parser.add_argument('-r', dest='remove_tasks', nargs='+', default=[])
-    parser.add_argument('-o', dest='output', required=True)
 
-    group = parser.add_mutually_exclusive_group()
-    group.add_argument('--sort', action='store_true')
-    group.add_argument('--reverse_sort', action='store_true')
-    group.add_argument('--random', action='store_true')
+def merge_tasks(task_lists, exclude_lists=()):
+    """merge lists of (x, y, rgb_hex), a later task of the same pixel
+    replaces the color but keeps the first position, the pixels in
+    exclude_lists are removed
+    """
+    tasks_order_dict = collections.OrderedDict()
+    for tasks_subset in task_lists:
+        for task in tasks_subset:
+            tasks_order_dict[tuple(task[:2])] = task[2]
 
-    # if we want to sort by y axis
-    parser.add_argument('--y', dest='sort_by_y', action='store_true')
+    exclude_set = set()
+    for tasks_subset in exclude_lists:
+        # add (x, y) coordinates to exclude_set
+        exclude_set.update({(task[0], task[1]) for task in tasks_subset})
 
-    args = parser.parse_args()
+    if exclude_set:
+        return [(xy[0], xy[1], rgb_hex)
+                for xy, rgb_hex in tasks_order_dict.items()
+                if xy not in exclude_set]
+    return [(xy[0], xy[1], rgb_hex)
+            for xy, rgb_hex in tasks_order_dict.items()]
 
-    tasks_order_dict = collections.OrderedDict()
 
-    for filename in args.files:
-        try:
-            with open(filename, 'r') as fp:
-                tasks_subset = json.load(fp)
-                for task in tasks_subset:
-                    tasks_order_dict[tuple(task[:2])] = task[2]
+def merge_priorities(task_lists, priority_dicts, tasks):
+    """return the priorities of the merged tasks, a later task of the same
+    pixel replaces the priority as well as the color
+    """
+    priorities = {}
+    for tasks_subset, subset_priorities in zip(task_lists, priority_dicts):
+        for task in tasks_subset:
+            xy = (task[0], task[1])
+            priority = subset_priorities.get(xy)
+            if priority:
+                priorities[xy] = priority
+            else:
+                priorities.pop(xy, None)
+    if not priorities:
+        return {}
+    # drop the excluded pixels
+    return {(task[0], task[1]): priorities[(task[0], task[1])]
+            for task in tasks if (task[0], task[1]) in priorities}
 
-        except IOError as e:
-            print("Cannot open file %s with error: %s" % (filename, e))
-        except ValueError as e:
-            print("Failed to decode JSON: %s" % e)
-        except Exception as e:
-            print("Error occurs when reading file %s: %s" % (filename, e))
 
-    exclude_set = set()
-    for filename in args.remove_tasks:
-        try:
-            with open(filename, 'r') as fp:
-                tasks_subset = json.load(fp)
-                # add (x, y) coordinates to exclude_set
-                exclude_set.update({(task[0], task[1])
-                                    for task in tasks_subset})
+def sort_tasks(tasks, reverse=False, sort_by_y=False):
+    if sort_by_y:
+        tasks.sort(key=lambda task: (task[1], task[0]), reverse=reverse)
+    else:
+        tasks.sort(reverse=reverse)
 
+
+def read_task_files(filenames):
+    """return the task list and the priorities dict of every file
+    """
+    task_lists = []
+    priority_dicts = []
+    for filename in filenames:
+        try:
+            tasks_subset, priorities = load_tasks(filename)
+            task_lists.append(tasks_subset)
+            priority_dicts.append(priorities)
         except IOError as e:
             print("Cannot open file %s with error: %s" % (filename, e))
         except ValueError as e:
             print("Failed to decode JSON: %s" % e)
         except Exception as e:
             print("Error occurs when reading file %s: %s" % (filename, e))
+    return task_lists, priority_dicts
 
-    if exclude_set:
-        tasks = [(xy[0], xy[1], rgb_hex)
-                 for xy, rgb_hex in tasks_order_dict.items()
-                 if xy not in exclude_set]
-    else:
-        tasks = [(xy[0], xy[1], rgb_hex)
-                 for xy, rgb_hex in tasks_order_dict.items()]
 
-    sort_func = None
-    if args.sort_by_y:
-        # don't know why, but code format convert my lambda function to a real
-        # function
-        def sort_func(x): return (x[1], x[0])
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', dest='files', nargs='+', required=True)
+    parser.add_argument('-r', dest='remove_tasks', nargs='+', default=[])
+    parser.add_argument('-o', dest='output', required=True)
+
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--sort', action='store_true')
+    group.add_argument('--reverse_sort', action='store_true')
+    group.add_argument('--random', action='store_true')
+
+    # if we want to sort by y axis
+    parser.add_argument('--y', dest='sort_by_y', action='store_true')
+
+    args = parser.parse_args()
+
+    task_lists, priority_dicts = read_task_files(args.files)
+    exclude_lists, _ = read_task_files(args.remove_tasks)
+    tasks = merge_tasks(task_lists, exclude_lists)
+    priorities = merge_priorities(task_lists, priority_dicts, tasks)
 
     if args.sort:
         print("Sorting order in ascending order")
-        tasks.sort(key=sort_func)
+        sort_tasks(tasks, sort_by_y=args.sort_by_y)
     elif args.reverse_sort:
         print("Sorting order in descending order")
-        tasks.sort(key=sort_func, reverse=True)
+        sort_tasks(tasks, reverse=True, sort_by_y=args.sort_by_y)
     elif args.random:
         print("Shuffling task orders")
         random.shuffle(tasks)
 
     try:
-        with open(args.output, "w") as fp:
-            json.dump(tasks, fp)
+        save_tasks(args.output, tasks, priorities)
         print("Writing %d tasks to %s" % (len(tasks), args.output))
+        if priorities and not is_binary_task_file(args.output):
+            print("Warning: the priorities of %d pixels are only kept in "
+                  "the binary format" % len(priorities))
     except IOError as e:
         print("Failed to write to output file %s: %s" % (args.output, e))
@@ -0,0 +1,226 @@
+"""
+Live metrics of guard.py and draw_pixel.py in the Prometheus text format,
+served on http://127.0.0.1:<port>/metrics when --metrics-port is given.
+
+The components only keep plain counters that are cheap enough to stay on,
+everything else is computed when the endpoint is scraped. The rates, e.g.,
+of bdraw_websocket_frames_total, are meant to be computed with rate() by
+Prometheus, bdraw_websocket_frames_per_second is the average since the
+previous scrape for a quick look with curl.
+"""
+
+import time
+from aiohttp import web
+import logger
+
+__all__ = ["Metrics", "MetricsServer", "add_metrics_argument"]
+
+LOGGER = logger.get_logger('metrics')
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, value)
+                             for name, value in labels)
+
+
+class MetricsWriter(object):
+    """Build the text of a scrape, one family of samples at a time
+    """
+
+    def __init__(self):
+        self.lines = []
+
+    def family(self, name, metric_type, help_text):
+        self.lines.append("# HELP %s %s" % (name, help_text))
+        self.lines.append("# TYPE %s %s" % (name, metric_type))
+
+    def sample(self, name, value, labels=()):
+        self.lines.append("%s%s %s" % (name, format_labels(labels),
+                                       format_value(value)))
+
+    def gauge(self, name, help_text, value):
+        self.family(name, "gauge", help_text)
+        self.sample(name, value)
+
+    def counter(self, name, help_text, value):
+        self.family(name, "counter", help_text)
+        self.sample(name, value)
+
+    def histogram(self, name, help_text, tracker):
+        """write a latency.LatencyTracker as a histogram
+        """
+        self.family(name, "histogram", help_text)
+        cumulative = 0
+        for bound, count in zip(tracker.buckets, tracker.counts):
+            cumulative += count
+            self.sample(name + "_bucket", cumulative,
+                        [("le", format_value(bound))])
+        self.sample(name + "_bucket", tracker.count, [("le", "+Inf")])
+        self.sample(name + "_sum", tracker.sum)
+        self.sample(name + "_count", tracker.count)
+
+    def text(self):
+        return "\n".join(self.lines) + "\n"
+
+
+class Metrics(object):
+    """Collect the state of an UpdateImage, its task queue, a Dispatcher and
+    a ConnectionPool, the ones that are None are left out
+    """
+
+    def __init__(self, up, task_queue, dispatcher=None, pool=None):
+        self.up = up
+        self.task_queue = task_queue
+        self.dispatcher = dispatcher
+        self.pool = pool
+        self.scrapes = 0
+        self._last_scrape = time.monotonic()
+        self._last_frames = up.frames
+
+    def collect(self):
+        writer = MetricsWriter()
+        self.scrapes += 1
+        self.collect_queue(writer)
+        self.collect_board(writer)
+        self.collect_websocket(writer)
+        if self.dispatcher is not None:
+            self.collect_accounts(writer)
+        if self.pool is not None:
+            self.collect_pool(writer)
+        return writer.text()
+
+    def collect_queue(self, writer):
+        writer.gauge("bdraw_task_queue_depth",
+                     "pixels waiting in the task queue",
+                     self.task_queue.qsize())
+        # only the PixelQueue of the guard leases pixels
+        if hasattr(self.task_queue, "leased"):
+            writer.gauge("bdraw_task_queue_leased",
+                         "pixels being repaired by an account",
+                         self.task_queue.leased())
+
+    def collect_board(self, writer):
+        up = self.up
+        tracker = up.tracker
+        if tracker is not None:
+            writer.gauge("bdraw_guard_pixels", "pixels of the guard region",
+                         tracker.total)
+            writer.gauge("bdraw_polluted_pixels",
+                         "pixels of the guard region with a wrong color",
+                         tracker.polluted_count)
+            writer.gauge("bdraw_guard_correct_percent",
+                         "percentage of the guard region with the correct "
+                         "color", tracker.progress)
+            writer.counter("bdraw_repaired_pixels_total",
+                           "polluted pixels repaired by our draws, as "
+                           "confirmed by a DRAW_UPDATE", tracker.repaired)
+            writer.histogram("bdraw_repair_latency_seconds",
+                             "seconds from the DRAW_UPDATE polluting a pixel "
+                             "to our accepted draw, observed when a "
+                             "DRAW_UPDATE confirms the draw",
+                             tracker.repair_latency)
+        writer.gauge("bdraw_board_mismatch_ratio",
+                     "ratio of pixels the WebSocket missed at the last full "
+                     "update", up.mismatch_ratio)
+        writer.gauge("bdraw_board_drift_rate",
+                     "pixels per second the WebSocket missed between the "
+                     "last two full updates", up.drift_rate)
+        writer.gauge("bdraw_refresh_interval_seconds",
+                     "seconds between full updates", up.refresh_interval)
+        if up.last_update is not None:
+            writer.gauge("bdraw_last_full_update_timestamp_seconds",
+                         "time of the last full update", up.last_update)
+
+    def collect_websocket(self, writer):
+        up = self.up
+        now = time.monotonic()
+        elapsed = now - self._last_scrape
+        fps = (up.frames - self._last_frames) / elapsed if elapsed else 0.0
+        self._last_scrape = now
+        self._last_frames = up.frames
+        writer.counter("bdraw_websocket_frames_total",
+                       "frames received from the WebSocket", up.frames)
+        writer.gauge("bdraw_websocket_frames_per_second",
+                     "frames per second since the previous scrape", fps)
+        writer.counter("bdraw_updates_applied_total",
+                       "DRAW_UPDATE pixels applied to the board",
+                       up.updates_applied)
+        writer.counter("bdraw_update_seconds_total",
+                       "seconds spent applying DRAW_UPDATE pixels",
+                       up.update_time)
+        writer.counter("bdraw_websocket_reconnects_total",
+                       "WebSocket reconnections", up.reconnects)
+        writer.counter("bdraw_websocket_resyncs_total",
+                       "reconnections followed by a full update",
+                       up.resyncs)
+
+    def collect_accounts(self, writer):
+        dispatcher = self.dispatcher
+        writer.family("bdraw_accounts", "gauge", "accounts by state")
+        for state, count in dispatcher.states().items():
+            writer.sample("bdraw_accounts", count, [("state", state)])
+        writer.family("bdraw_draws_total", "counter",
+                      "draw responses by status code, \"failed\" if no "
+                      "response is received")
+        for status_code, count in sorted(dispatcher.results.items(),
+                                         key=lambda item: str(item[0])):
+            status = "failed" if status_code is None else status_code
+            writer.sample("bdraw_draws_total", count, [("status", status)])
+        writer.histogram("bdraw_draw_latency_seconds",
+                         "round-trip time of the draw requests",
+                         dispatcher.latency)
+
+    def collect_pool(self, writer):
+        stats = self.pool.connector.stats()
+        writer.counter("bdraw_connections_acquired_total",
+                       "connections acquired by requests", stats["acquired"])
+        writer.counter("bdraw_connections_created_total",
+                       "connections opened", stats["created"])
+        writer.gauge("bdraw_connections_idle",
+                     "idle keep-alive connections", stats["idle"])
+        writer.counter("bdraw_connection_wait_seconds_total",
+                       "seconds waiting for a free connection",
+                       stats["wait_time"])
+
+
+class MetricsServer(object):
+    """Serve Metrics.collect() on GET /metrics
+    """
+
+    def __init__(self, metrics, port, host="127.0.0.1", *, loop):
+        self.metrics = metrics
+        self.port = port
+        self.host = host
+        self.loop = loop
+        self.app = web.Application()
+        self.app.router.add_get("/metrics", self.handle_metrics)
+        self._runner = web.AppRunner(self.app, access_log=None)
+
+    async def handle_metrics(self, request):
+        return web.Response(body=self.metrics.collect().encode('utf-8'),
+                            headers={"Content-Type": CONTENT_TYPE})
+
+    async def start(self):
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        LOGGER.critical("serving metrics on http://%s:%d/metrics" %
+                        (self.host, self.port))
+
+    async def close(self):
+        await self._runner.cleanup()
+
+
+def add_metrics_argument(parser):
+    parser.add_argument('--metrics-port', type=int, metavar='port',
+                        help="serve Prometheus metrics on "
+                        "http://127.0.0.1:<port>/metrics")
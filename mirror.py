@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Mirror daemon. Keep the sketch board current in a memory-mapped file and
+notify the attached tools of every change through a local socket, so they
+start without downloading the full bitmap or opening their own WebSocket.
+See canvas_mirror.py for the formats, and the --mirror option of the tools.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from canvas_mirror import MirrorFile, MIRROR_PATH, encode_updates,\
+    encode_full_update
+from update_image import UpdateImage
+import logger
+
+LOGGER = logger.get_logger('mirror')
+
+# drop a client when this many bytes are waiting to be sent to it
+MAX_CLIENT_BUFFER = 1 << 20
+
+
+class MirrorDaemon(object):
+    def __init__(self, path, *, loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        self.mirror = MirrorFile(path, create=True)
+        self.up = UpdateImage(loop=loop, canvas=self.mirror.canvas)
+        self.up.update_callback = self.on_update
+        self.up.full_update_callback = self.on_full_update
+        self.clients = set()
+        self.server = None
+
+    async def start(self):
+        if os.path.exists(self.mirror.socket_path):
+            os.unlink(self.mirror.socket_path)
+        self.server = await asyncio.start_unix_server(
+            self.on_client, self.mirror.socket_path, loop=self.loop)
+        await self.up.perform_update_image()
+        asyncio.ensure_future(self.up.start_websocket(), loop=self.loop)
+        LOGGER.critical("mirroring the sketch board to %s" % self.mirror.path)
+
+    async def on_client(self, reader, writer):
+        self.clients.add(writer)
+        LOGGER.info("%d tools attached" % len(self.clients))
+        try:
+            # clients never send anything, wait until they disconnect
+            await reader.read()
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+            LOGGER.info("%d tools attached" % len(self.clients))
+
+    def on_update(self, update_list):
+        if update_list:
+            seq = self.mirror.publish()
+            self.broadcast(encode_updates(seq, update_list))
+
+    def on_full_update(self):
+        seq = self.mirror.publish(time.time())
+        self.broadcast(encode_full_update(seq))
+
+    def broadcast(self, data):
+        for writer in list(self.clients):
+            if writer.transport.get_write_buffer_size() > MAX_CLIENT_BUFFER:
+                LOGGER.warning("dropping a client not reading notifications")
+                self.clients.discard(writer)
+                writer.close()
+                continue
+            writer.write(data)
+
+    def close(self):
+        self.up.close()
+        for writer in self.clients:
+            writer.close()
+        if self.server is not None:
+            self.server.close()
+            os.unlink(self.mirror.socket_path)
+        self.mirror.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', nargs='?', default=MIRROR_PATH,
+                        help="mirror file, the socket is the same path with "
+                        "the .sock suffix")
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    daemon = MirrorDaemon(args.path, loop=loop)
+    try:
+        loop.run_until_complete(daemon.start())
+        loop.run_forever()
+    except KeyboardInterrupt:
+        LOGGER.critical("Ctrl-c pressed, exiting")
+    finally:
+        daemon.close()
+        loop.stop()
+        loop.close()
+        sys.exit()
+
+
+if __name__ == "__main__":
+    main()
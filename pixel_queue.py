@@ -0,0 +1,116 @@
+import asyncio
+import collections
+import heapq
+import itertools
+
+__all__ = ["PixelQueue"]
+
+
+class PixelQueue(object):
+    """Priority queue of (priority, x, y, color_code) keyed by pixel
+
+    It is a drop-in replacement of asyncio.PriorityQueue for the guard. A
+    pixel has at most one live entry: putting it again updates the color and
+    keeps the lower priority value. A pixel returned by get() is leased until
+    release() is called, puts during the lease are merged and queued again
+    on release, so two workers never work on the same pixel.
+    """
+
+    def __init__(self, *, loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self._loop = loop
+        # [priority, sequence, (x, y), color_code], removed entries have
+        # their key set to None
+        self._heap = []
+        self._entries = {}
+        # (x, y) -> item put during the lease, or None
+        self._leased = {}
+        self._counter = itertools.count()
+        self._getters = collections.deque()
+
+    def qsize(self):
+        return len(self._entries)
+
+    def empty(self):
+        return not self._entries
+
+    def leased(self):
+        return len(self._leased)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def put_nowait(self, item):
+        priority, x, y, color_code = item
+        key = (x, y)
+        if key in self._leased:
+            pending = self._leased[key]
+            if pending is not None and pending[0] < priority:
+                priority = pending[0]
+            self._leased[key] = (priority, x, y, color_code)
+            return
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            if priority >= entry[0]:
+                entry[3] = color_code
+                return
+            # decrease-key, the old entry is skipped when popped
+            entry[2] = None
+
+        entry = [priority, next(self._counter), key, color_code]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+        self._wakeup_next()
+
+    async def put(self, item):
+        self.put_nowait(item)
+
+    def discard(self, x, y):
+        """remove the live entry of a pixel, e.g., it has been repaired
+        """
+        entry = self._entries.pop((x, y), None)
+        if entry is not None:
+            entry[2] = None
+
+    def get_nowait(self):
+        while self._heap:
+            priority, _, key, color_code = heapq.heappop(self._heap)
+            if key is None:
+                continue
+            del self._entries[key]
+            self._leased[key] = None
+            return (priority, key[0], key[1], color_code)
+        raise asyncio.QueueEmpty()
+
+    async def get(self):
+        while self.empty():
+            getter = self._loop.create_future()
+            self._getters.append(getter)
+            try:
+                await getter
+            except BaseException:
+                getter.cancel()
+                try:
+                    self._getters.remove(getter)
+                except ValueError:
+                    pass
+                if not self.empty() and not getter.cancelled():
+                    self._wakeup_next()
+                raise
+        return self.get_nowait()
+
+    def release(self, x, y):
+        """finish the lease of a pixel returned by get()
+        """
+        pending = self._leased.pop((x, y), None)
+        if pending is not None:
+            self.put_nowait(pending)
+
+    def _wakeup_next(self):
+        while self._getters:
+            getter = self._getters.popleft()
+            if not getter.done():
+                getter.set_result(None)
+                break
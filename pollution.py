@@ -0,0 +1,149 @@
+import time
+import numpy as np
+from latency import LatencyTracker
+from util import CODE_INDEX_TABLE, TaskSet
+
+__all__ = ["PollutionTracker"]
+
+# target value of pixels outside the guard region
+NO_TARGET = 0xff
+# seconds a drawn pixel waits for the canvas to show its color before a full
+# update may queue it again
+PENDING_TIMEOUT = 30
+
+
+class PollutionTracker(object):
+    """Keep the live set of guarded pixels whose color differs from the
+    target, so the guard never needs to rescan the whole task
+
+    Pixels are identified by their flat index y * width + x. A pixel whose
+    draw is accepted is pending until the canvas shows its color, it is
+    still counted as polluted but isn't queued again. The time a pixel is
+    polluted by an update is kept, and the seconds until our draw of it is
+    accepted are observed by repair_latency once the update of our draw
+    confirms the repaint.
+    """
+
+    def __init__(self, canvas, tasks_dict):
+        self.canvas = canvas
+        self.width = canvas.width
+        self.target = bytearray([NO_TARGET]) * (canvas.width * canvas.height)
+        self.total = 0
+        # nothing is known to be polluted until the first rescan()
+        self.polluted = set()
+        # index -> time.monotonic() when the pixel was polluted
+        self.polluted_at = {}
+        # index -> (time.monotonic() of our accepted draw, seconds from the
+        # pollution to the draw or None) of the pending pixels
+        self.pending = {}
+        self.repair_latency = LatencyTracker()
+        self.repaired = 0
+        if isinstance(tasks_dict, TaskSet):
+            self._set_targets(tasks_dict)
+        else:
+            for (x, y), color_code in tasks_dict.items():
+                self._set_target(x, y, color_code)
+
+    def _set_targets(self, task_set):
+        size = len(self.target)
+        present = np.unpackbits(np.frombuffer(task_set.presence, np.uint8),
+                                bitorder="little")[:size].astype(bool)
+        codes = np.frombuffer(task_set.codes, np.uint8)
+        self.target[:] = np.where(present, codes, NO_TARGET).tobytes()
+        self.total = len(task_set)
+
+    def _set_target(self, x, y, color_code):
+        index = y * self.width + x
+        if self.target[index] == NO_TARGET:
+            self.total += 1
+        self.target[index] = CODE_INDEX_TABLE[color_code]
+
+    def set_target(self, x, y, color_code):
+        """add or change a guarded pixel, return True if it becomes polluted
+        """
+        self._set_target(x, y, color_code)
+        return self.update(x, y)
+
+    def update(self, x, y):
+        """re-check a pixel after the canvas changed, return True only if a
+        correct pixel becomes polluted
+        """
+        index = y * self.width + x
+        target = self.target[index]
+        if target == NO_TARGET:
+            return False
+        if target != self.canvas.buffer[index]:
+            if index in self.polluted:
+                return False
+            self.polluted.add(index)
+            self.polluted_at[index] = time.monotonic()
+            # our draw, if any, is overwritten
+            self.pending.pop(index, None)
+            return True
+        if index in self.polluted:
+            self.polluted.remove(index)
+            self.polluted_at.pop(index, None)
+        pending = self.pending.pop(index, None)
+        if pending is not None and pending[1] is not None:
+            self.repaired += 1
+            self.repair_latency.observe(pending[1])
+        return False
+
+    def mark_drawn(self, x, y):
+        """called when our draw of a pixel is accepted, the pixel is pending
+        until the canvas shows its color, and the next pollution is queued
+        again even if the DRAW_UPDATE of our draw is missed
+        """
+        index = y * self.width + x
+        self.polluted.discard(index)
+        now = time.monotonic()
+        polluted_at = self.polluted_at.pop(index, None)
+        latency = None if polluted_at is None else now - polluted_at
+        self.pending[index] = (now, latency)
+
+    def rescan(self):
+        """compare the whole canvas with the target after a full update,
+        return the (x, y) of pixels that were not known to be polluted
+        """
+        target = np.frombuffer(self.target, dtype=np.uint8)
+        current = np.frombuffer(self.canvas.buffer, dtype=np.uint8)
+        mismatch = np.flatnonzero((target != NO_TARGET) & (target != current))
+        polluted = set(mismatch.tolist())
+        # a pending pixel may not be drawn in the full update yet, it is only
+        # queued again if the canvas doesn't show its color in time, and
+        # forgotten if it does, only repaints confirmed by a DRAW_UPDATE are
+        # observed
+        expired = time.monotonic() - PENDING_TIMEOUT
+        pending = self.pending
+        for index, (drawn_at, _) in list(pending.items()):
+            if index not in polluted or drawn_at < expired:
+                del pending[index]
+            else:
+                polluted.discard(index)
+        new_polluted = sorted(polluted - self.polluted)
+        # only pollutions seen in a DRAW_UPDATE are timed, forget the ones
+        # repaired while the WebSocket missed it
+        polluted_at = self.polluted_at
+        for index in [index for index in polluted_at
+                      if index not in polluted]:
+            del polluted_at[index]
+        self.polluted = polluted
+        width = self.width
+        return [(index % width, index // width) for index in new_polluted]
+
+    def is_polluted(self, x, y):
+        return y * self.width + x in self.polluted
+
+    @property
+    def polluted_count(self):
+        """number of pixels with a wrong color, including the pending ones
+        """
+        return len(self.polluted) + len(self.pending)
+
+    @property
+    def progress(self):
+        """percentage of guarded pixels with the correct color
+        """
+        if self.total == 0:
+            return 100.0
+        return 100.0 * (self.total - self.polluted_count) / self.total
@@ -1,8 +1,24 @@
 import sys
 import time
 
+import numpy as np
 from PIL import Image
-from util import find_nearest_color, hex_to_rgb, COLOR_CODE_TABLE
+from util import load_palette_lut, CODE_RGB_TABLE, PALETTE_CODES
+
+# palette index -> (r, g, b)
+PALETTE_RGB = np.array([CODE_RGB_TABLE[code] for code in PALETTE_CODES],
+                       dtype=np.uint8)
+
+
+def convert_image(image):
+    """replace every color of a RGBA image with the nearest available color,
+    return the new image and the number of distinct input colors
+    """
+    data = np.array(image)
+    rgb = data[:, :, :3].astype(np.uint32)
+    packed = (rgb[:, :, 0] << 16) | (rgb[:, :, 1] << 8) | rgb[:, :, 2]
+    data[:, :, :3] = PALETTE_RGB[load_palette_lut()[packed]]
+    return Image.fromarray(data, "RGBA"), len(np.unique(packed))
 
 
 if __name__ == '__main__':
@@ -15,28 +31,11 @@ if __name__ == '__main__':
     image = Image.open(in_filename)
     if image.mode != "RGBA":
         image = image.convert("RGBA")
-    width, height = image.size
     print("Start converting")
     start_time = time.time()
-    cache = {}
-    rgb_table = {hex_to_rgb(rgb_hex) for rgb_hex in COLOR_CODE_TABLE.keys()}
-
-    def process_rgba(r, g, b, a):
-        rgb = (r, g, b)
-        if rgb in rgb_table:
-            rr, gg, bb = r, g, b
-        elif rgb in cache:
-            rr, gg, bb = cache[rgb]
-        else:
-            nearest_rgb_hex = find_nearest_color(r, g, b)
-            rr, gg, bb = hex_to_rgb(nearest_rgb_hex)
-            cache[rgb] = rr, gg, bb
-        return (rr, gg, bb, a)
-
-    rgba_data = [process_rgba(*rgba) for rgba in image.getdata()]
-    image.putdata(rgba_data)
+    image, colors = convert_image(image)
 
     print("Cost %.2f seconds, processed %d colors" %
-          (time.time() - start_time, len(cache)))
+          (time.time() - start_time, colors))
     print("Writing to %s" % out_filename)
     image.save(out_filename)
@@ -0,0 +1,216 @@
+"""
+Profiling mode of guard.py, draw_pixel.py and record.py, enabled by
+--profile. It finds what keeps the event loop busy:
+
+* the event loop lag, how late a sleeping coroutine is woken up
+* callbacks running longer than --slow-callback seconds, with the
+  coroutine or function responsible
+* stack samples of the event loop thread, attributed to the innermost
+  subsystem on the stack: ingest (WebSocket frames, the board and full
+  updates), scheduler, HTTP, logging, the event loop itself, or idle when
+  waiting for events
+
+The summary is reported at exit.
+"""
+
+import asyncio
+import collections
+import os
+import sys
+import threading
+import time
+from latency import LatencyTracker, LAG_BUCKETS
+import logger
+
+__all__ = ["Profiler", "probe_loop_lag", "add_profile_arguments"]
+
+LOGGER = logger.get_logger('profiling')
+
+# subsystem, module filenames and package directories, a stack sample is
+# attributed to the first subsystem found from the innermost frame
+SUBSYSTEMS = (
+    ("logging", {"logger.py"}, {"logging"}),
+    ("idle", {"selectors.py"}, set()),
+    ("ingest", {"update_image.py", "frame_parser.py", "pollution.py",
+                "canvas.py", "canvas_mirror.py", "journal.py"}, {"json"}),
+    ("scheduler", {"scheduler.py", "pixel_queue.py", "guard.py",
+                   "draw_pixel.py", "record.py"}, set()),
+    ("http", {"connection_pool.py", "ssl.py", "socket.py"},
+     {"aiohttp", "yarl", "multidict"}),
+    # the event loop itself, the frames outside it are not attributed
+    ("asyncio", {"base_events.py"}, set()),
+)
+
+
+async def probe_loop_lag(loop, tracker, interval=0.05):
+    """measure how late the event loop wakes up a sleeping coroutine
+    """
+    while True:
+        start_time = loop.time()
+        await asyncio.sleep(interval, loop=loop)
+        tracker.observe(max(loop.time() - start_time - interval, 0))
+
+
+def describe_callback(handle):
+    """return the coroutine of a task step with the line it awaits at
+    next, i.e., right after the blocking code, or the function of a plain
+    callback
+    """
+    callback = handle._callback
+    task = getattr(callback, "__self__", None)
+    if isinstance(task, asyncio.Task):
+        coro = task._coro
+        frame = getattr(coro, "cr_frame", None)
+        if frame is None:
+            return getattr(coro, "__qualname__", repr(coro))
+        filename = os.path.basename(frame.f_code.co_filename)
+        return "%s, awaiting at %s:%d" % (coro.__qualname__, filename,
+                                          frame.f_lineno)
+    return getattr(callback, "__qualname__", repr(callback))
+
+
+def classify(frame):
+    """return the subsystem and the innermost frame of a stack
+    """
+    innermost = frame
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        name = os.path.basename(filename)
+        package = os.path.basename(os.path.dirname(filename))
+        for subsystem, modules, packages in SUBSYSTEMS:
+            if name in modules or package in packages:
+                return subsystem, innermost
+        frame = frame.f_back
+    return "other", innermost
+
+
+def format_frame(frame):
+    return "%s:%d %s" % (os.path.basename(frame.f_code.co_filename),
+                         frame.f_lineno, frame.f_code.co_name)
+
+
+class Profiler(object):
+    """Measure the event loop lag, record slow callbacks and sample the
+    stack of the event loop thread between start() and stop()
+
+    Slow callbacks are found by timing asyncio.events.Handle._run, which
+    runs every callback and task step, so the loop doesn't need the slower
+    debug mode.
+    """
+
+    def __init__(self, *, loop, slow_callback=0.05, sample_interval=0.01,
+                 lag_interval=0.05):
+        self.loop = loop
+        self.slow_callback = slow_callback
+        self.sample_interval = sample_interval
+        self.lag_interval = lag_interval
+        self.lag = LatencyTracker(buckets=LAG_BUCKETS)
+        # description -> [count, total seconds, max seconds]
+        self.slow_callbacks = {}
+        self.subsystems = collections.Counter()
+        # (subsystem, innermost frame) -> number of samples
+        self.locations = collections.Counter()
+        self.samples = 0
+        self.start_time = None
+        self.duration = 0.0
+        self._original_run = None
+        self._lag_task = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """call it in the thread running the event loop
+        """
+        self.start_time = time.perf_counter()
+        self._patch_handle()
+        self._lag_task = asyncio.ensure_future(
+            probe_loop_lag(self.loop, self.lag, self.lag_interval),
+            loop=self.loop)
+        self._thread = threading.Thread(
+            target=self._sample, args=(threading.get_ident(),),
+            name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self.start_time is None:
+            return
+        self.duration = time.perf_counter() - self.start_time
+        self.start_time = None
+        asyncio.events.Handle._run = self._original_run
+        self._lag_task.cancel()
+        self._stop.set()
+        self._thread.join()
+
+    def _patch_handle(self):
+        original_run = self._original_run = asyncio.events.Handle._run
+        threshold = self.slow_callback
+        perf_counter = time.perf_counter
+        profiler = self
+
+        def _run(handle):
+            start_time = perf_counter()
+            original_run(handle)
+            cost = perf_counter() - start_time
+            if cost >= threshold:
+                profiler.record_slow_callback(handle, cost)
+        asyncio.events.Handle._run = _run
+
+    def record_slow_callback(self, handle, cost):
+        description = describe_callback(handle)
+        LOGGER.warning("%s blocked the event loop for %.3fs" %
+                       (description, cost))
+        entry = self.slow_callbacks.setdefault(description, [0, 0.0, 0.0])
+        entry[0] += 1
+        entry[1] += cost
+        entry[2] = max(entry[2], cost)
+
+    def _sample(self, thread_id):
+        while not self._stop.wait(self.sample_interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+            subsystem, innermost = classify(frame)
+            self.subsystems[subsystem] += 1
+            self.locations[subsystem, format_frame(innermost)] += 1
+            self.samples += 1
+            # don't keep the frames of the event loop thread alive
+            del frame, innermost
+
+    def report(self, top=5):
+        lines = ["profiled %.1fs" % self.duration]
+        lag = self.lag
+        if lag.count:
+            lines.append(
+                "event loop lag: mean %.4fs, p50 %.4fs, p99 %.4fs, "
+                "max %.4fs, %d samples" %
+                (lag.sum / lag.count, lag.percentile(50), lag.percentile(99),
+                 lag.max, lag.count))
+        slow = sorted(self.slow_callbacks.items(),
+                      key=lambda item: item[1][1], reverse=True)
+        lines.append("slow callbacks (>= %.3fs): %d, %.2fs in total" %
+                     (self.slow_callback, sum(v[0] for _, v in slow),
+                      sum(v[1] for _, v in slow)))
+        for description, (count, total, longest) in slow[:top]:
+            lines.append("  %5d %8.3fs total %7.3fs max  %s" %
+                         (count, total, longest, description))
+        lines.append("event loop thread, %d stack samples:" % self.samples)
+        for subsystem, count in self.subsystems.most_common():
+            lines.append("  %-9s %5.1f%%" %
+                         (subsystem, 100.0 * count / self.samples))
+            locations = [(location, n) for (name, location), n
+                         in self.locations.most_common() if name == subsystem]
+            for location, n in locations[:top]:
+                lines.append("      %5.1f%%  %s" %
+                             (100.0 * n / self.samples, location))
+        return "\n".join(lines)
+
+
+def add_profile_arguments(parser):
+    group = parser.add_argument_group("profiling")
+    group.add_argument('--profile', action='store_true',
+                       help="measure the event loop lag, slow callbacks and "
+                       "where the event loop spends its time, reported at "
+                       "exit")
+    group.add_argument('--slow-callback', type=float, default=0.05,
+                       metavar='seconds',
+                       help="report callbacks running longer than this")
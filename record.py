@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
 
+import argparse
 import asyncio
 import os
 from datetime import datetime
+from canvas_mirror import add_mirror_argument
+from journal import JournalWriter
+from profiling import Profiler, add_profile_arguments
 from update_image import UpdateImage
 
 interval = 180
@@ -25,23 +29,63 @@ async def recording(up):
     while True:
         await up.perform_update_image()
         filename = filename_template.format(datetime.now())
-        up.save_buffer_to_file(filename)
+        await up.async_save_buffer_to_file(filename)
         print_log(filename)
         await asyncio.sleep(interval)
 
+
+async def journaling(up, writer):
+    """write every change received from the WebSocket to the journal
+    """
+    await up.perform_update_image()
+    asyncio.ensure_future(up.start_websocket())
+    print("@%s record changes to journal %s" %
+          (datetime.now(), writer.filename))
+    while True:
+        await asyncio.sleep(1)
+        writer.flush()
+
 if __name__ == "__main__":
-    if not os.path.exists('autosave'):
-        print("Create output folder autosave")
-        os.makedirs("autosave")
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--journal', metavar='journal_file',
+                        help="record every change to a journal instead of "
+                        "saving images, see journal.py")
+    parser.add_argument('--keyframe-interval', type=float, default=600,
+                        help="seconds between the keyframes of the journal")
+    add_mirror_argument(parser)
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    up = UpdateImage(mirror=args.mirror)
+    writer = None
+    if args.journal:
+        writer = JournalWriter(args.journal, up.canvas,
+                               args.keyframe_interval)
+        up.update_callback = writer.write_updates
+        up.full_update_callback = writer.write_keyframe
+        coroutine = journaling(up, writer)
+    else:
+        if not os.path.exists('autosave'):
+            print("Create output folder autosave")
+            os.makedirs("autosave")
+        coroutine = asyncio.gather(recording(up), wakeup())
 
-    up = UpdateImage()
     print("Start @%s" % datetime.now())
     loop = asyncio.get_event_loop()
+    profiler = None
+    if args.profile:
+        profiler = Profiler(loop=loop, slow_callback=args.slow_callback)
+        profiler.start()
     try:
-        loop.run_until_complete(asyncio.gather(recording(up), wakeup()))
+        loop.run_until_complete(coroutine)
     except KeyboardInterrupt:
         print("Ctrl+C pressed, existing")
     finally:
         up.close()
+        if writer is not None:
+            writer.close()
+        if profiler is not None:
+            profiler.stop()
+            print(profiler.report())
         loop.stop()
         loop.close()
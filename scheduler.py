@@ -0,0 +1,201 @@
+import asyncio
+import collections
+import heapq
+import itertools
+import logger
+from latency import LatencyTracker
+
+__all__ = ["Account", "Dispatcher", "DrawResult"]
+
+LOGGER = logger.get_logger('scheduler')
+
+# cost_time and status_code are None if no request was sent, status_code is
+# also None if the request failed
+DrawResult = collections.namedtuple("DrawResult",
+                                    ["wait_time", "cost_time", "status_code"])
+
+# seconds added to the cool-down of an account after an early rejection
+MARGIN_STEP = 0.05
+MAX_MARGIN = 2.0
+
+
+class Account(object):
+    def __init__(self, worker_id, user_id, session):
+        self.worker_id = worker_id
+        self.user_id = user_id
+        self.session = session
+        # loop time when the cool-down ends
+        self.ready_at = 0
+        self.enabled = True
+        self.latency = LatencyTracker()
+        # safety margin added to the latency-compensated cool-down, it grows
+        # when the server rejects a request sent too early
+        self.margin = 0.0
+        self.prefired = False
+
+
+class Dispatcher(object):
+    """Hand the most urgent task to an account the moment its cool-down ends
+
+    Accounts wait in a heap ordered by the time they are ready, instead of
+    every account sleeping in its own coroutine with a task already bound
+    to it. handler(account, task) is a coroutine that works on the task and
+    returns a DrawResult, or None to retire the account.
+
+    The cool-down reported by the server starts when the server handles the
+    request, about half a round trip before the response arrives, and the
+    next request needs another half to get there. So the next request is
+    sent one round trip (the EWMA of the account) before the cool-down ends.
+    """
+
+    def __init__(self, accounts, task_queue, handler, *, loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        self.task_queue = task_queue
+        self.handler = handler
+        self._heap = []
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event(loop=loop)
+        self._running = set()
+        # every account ever added, including the retired ones
+        self._accounts = set()
+        # the ready account popped from the heap while waiting for a task
+        self._waiting = None
+        self.latency = LatencyTracker()
+        # status code -> number of responses, None for failed requests
+        self.results = collections.Counter()
+        for account in accounts:
+            self.add(account)
+
+    def add(self, account, wait_time=0):
+        account.ready_at = self.loop.time() + wait_time
+        self._accounts.add(account)
+        heapq.heappush(self._heap,
+                       (account.ready_at, next(self._counter), account))
+        self._wakeup.set()
+
+    def retire(self, account):
+        account.enabled = False
+
+    def accounts(self):
+        """number of accounts that are cooling down or ready
+        """
+        return len(self._heap) + (self._waiting is not None)
+
+    def upcoming(self, within):
+        """number of accounts that will be ready within the given seconds
+        """
+        deadline = self.loop.time() + within
+        return sum(1 for ready_at, _, account in self._heap
+                   if ready_at <= deadline and account.enabled)
+
+    def busy(self):
+        """number of accounts that are working on a task
+        """
+        return len(self._running)
+
+    def states(self):
+        """count the accounts by state: cooling, ready, working on a task,
+        or invalid (retired, e.g., the cookie expired)
+        """
+        now = self.loop.time()
+        counts = collections.OrderedDict(
+            [("cooling", 0), ("ready", 0), ("working", 0), ("invalid", 0)])
+        waiting = set()
+        for ready_at, _, account in self._heap:
+            if account.enabled:
+                waiting.add(account)
+                counts["cooling" if ready_at > now else "ready"] += 1
+        account = self._waiting
+        if account is not None and account.enabled:
+            waiting.add(account)
+            counts["ready"] += 1
+        for account in self._accounts:
+            if not account.enabled:
+                counts["invalid"] += 1
+            elif account not in waiting:
+                counts["working"] += 1
+        return counts
+
+    async def run(self):
+        loop = self.loop
+        heap = self._heap
+        while True:
+            self._wakeup.clear()
+            if not heap:
+                await self._wakeup.wait()
+                continue
+
+            ready_at, _, account = heap[0]
+            delay = ready_at - loop.time()
+            if delay > 0:
+                # an account added meanwhile may be ready earlier
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay,
+                                           loop=loop)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(heap)
+            if not account.enabled:
+                continue
+            self._waiting = account
+            try:
+                task = await self.task_queue.get()
+            finally:
+                self._waiting = None
+            future = asyncio.ensure_future(self._work(account, task),
+                                           loop=loop)
+            self._running.add(future)
+            future.add_done_callback(self._running.discard)
+
+    def cool_down(self, account, result):
+        """return the delay before the account sends its next request
+        """
+        if result.cost_time is not None:
+            self.results[result.status_code] += 1
+        # failed requests may include a long timeout, don't count them
+        if result.status_code is not None:
+            account.latency.observe(result.cost_time)
+            self.latency.observe(result.cost_time)
+
+        if result.status_code == 0:
+            account.margin *= 0.9
+        elif result.status_code not in (None, -101) and account.prefired:
+            # probably sent before the cool-down ended, back off
+            account.margin = min(account.margin * 2 + MARGIN_STEP,
+                                 MAX_MARGIN)
+            LOGGER.debug("<worker-%s> rejected with status %s, margin %.3fs"
+                         % (account.worker_id, result.status_code,
+                            account.margin))
+
+        wait_time = result.wait_time
+        account.prefired = False
+        if wait_time <= 0:
+            return 0
+        rtt = account.latency.ewma
+        if rtt is None:
+            rtt = self.latency.ewma or 0
+        lead = rtt - account.margin
+        if lead > 0:
+            account.prefired = True
+            return max(wait_time - lead, 0)
+        return wait_time
+
+    async def _work(self, account, task):
+        try:
+            result = await self.handler(account, task)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            LOGGER.error("<worker-%s> error occurs: %s" %
+                         (account.worker_id, e))
+            # avoid busy loop
+            result = DrawResult(30, None, None)
+
+        if result is None:
+            self.retire(account)
+        if account.enabled:
+            self.add(account, self.cool_down(account, result))
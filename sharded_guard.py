@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+Multi-process guard. The main process owns UpdateImage, the WebSocket, the
+PollutionTracker and the task queue like guard.py, and keeps the canvas in
+shared memory. Every worker process drives a shard of the accounts in the
+user file. When an account of a shard is ready, the shard asks the main
+process for the most urgent task through its pipe, so all the shards share
+one task queue and a pixel is repaired by one account at a time. The shard
+reports back the tasks given back, released and drawn, which the main
+process applies to the task queue and the tracker.
+
+Messages sent by a shard:
+
+("get",)          - an account is ready, answered with a task
+("put", task)     - give a task back, e.g., the draw failed
+("release", x, y) - finish the lease of a pixel
+("drawn", x, y)   - our draw of a pixel is accepted
+
+Requires Python 3.8 or 3.9: shared memory is new in 3.8, and the event loop
+is passed by loop= arguments, which were removed in 3.10.
+"""
+
+import argparse
+import asyncio
+import collections
+import functools
+import multiprocessing
+import sys
+from multiprocessing import shared_memory
+from canvas import Canvas
+from connection_pool import ConnectionPool, add_pool_arguments
+from guard import repair_pixel, load_sessions, populate_tasks,\
+    read_user_cmds
+from pixel_queue import PixelQueue
+from scheduler import Account, Dispatcher
+from task_file import load_tasks_dict
+from update_image import UpdateImage
+import logger
+
+LOGGER = logger.get_logger('sharded_guard')
+
+WIDTH = 1280
+HEIGHT = 720
+SHARED_SIZE = WIDTH * HEIGHT
+
+
+class TaskServer(object):
+    """Serve the task queue and the tracker of the main process to the
+    shards, one pipe per shard
+    """
+
+    def __init__(self, conns, task_queue, tracker, *, loop):
+        self.conns = conns
+        self.task_queue = task_queue
+        self.tracker = tracker
+        self.loop = loop
+        # coroutines getting a task from the queue for the shards
+        self._senders = set()
+        for conn in conns:
+            loop.add_reader(conn.fileno(), self._on_readable, conn)
+
+    def _on_readable(self, conn):
+        try:
+            while conn.poll():
+                self._handle(conn, conn.recv())
+        except (EOFError, OSError):
+            # the shard exited
+            self.loop.remove_reader(conn.fileno())
+
+    def _handle(self, conn, message):
+        kind = message[0]
+        if kind == "get":
+            sender = asyncio.ensure_future(self._send_task(conn),
+                                           loop=self.loop)
+            self._senders.add(sender)
+            sender.add_done_callback(self._senders.discard)
+        elif kind == "put":
+            self.task_queue.put_nowait(message[1])
+        elif kind == "release":
+            self.task_queue.release(message[1], message[2])
+        elif kind == "drawn":
+            self.tracker.mark_drawn(message[1], message[2])
+
+    async def _send_task(self, conn):
+        task = await self.task_queue.get()
+        try:
+            conn.send(task)
+        except OSError:
+            _, x, y, _ = task
+            self.task_queue.put_nowait(task)
+            self.task_queue.release(x, y)
+
+    async def close(self):
+        for conn in self.conns:
+            self.loop.remove_reader(conn.fileno())
+        senders = list(self._senders)
+        for sender in senders:
+            sender.cancel()
+        await asyncio.gather(*senders, loop=self.loop,
+                             return_exceptions=True)
+
+
+class TaskClient(object):
+    """Task queue of a shard, forwarding to the TaskServer of the main
+    process, it also stands in for the PollutionTracker of repair_pixel
+    """
+
+    def __init__(self, conn, *, loop):
+        self.conn = conn
+        self.loop = loop
+        self._getters = collections.deque()
+        loop.add_reader(conn.fileno(), self._on_readable)
+
+    async def get(self):
+        getter = self.loop.create_future()
+        self._getters.append(getter)
+        self.conn.send(("get",))
+        return await getter
+
+    def _on_readable(self):
+        try:
+            while self.conn.poll():
+                self._deliver(self.conn.recv())
+        except (EOFError, OSError):
+            LOGGER.error("the main process closed the pipe")
+            self.loop.remove_reader(self.conn.fileno())
+
+    def _deliver(self, task):
+        while self._getters:
+            getter = self._getters.popleft()
+            if not getter.done():
+                getter.set_result(task)
+                return
+        # the account stopped waiting, give the task back
+        _, x, y, _ = task
+        self.put_nowait(task)
+        self.release(x, y)
+
+    def put_nowait(self, task):
+        self.conn.send(("put", task))
+
+    def release(self, x, y):
+        self.conn.send(("release", x, y))
+
+    def mark_drawn(self, x, y):
+        self.conn.send(("drawn", x, y))
+
+    def close(self):
+        self.loop.remove_reader(self.conn.fileno())
+        self.conn.close()
+
+
+class Shard(object):
+    """stands in for the UpdateImage of repair_pixel, with the shared canvas
+    """
+
+    def __init__(self, canvas, tracker):
+        self.canvas = canvas
+        self.tracker = tracker
+
+
+def run_shard(shard, shards, shm_name, conn, args):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    canvas = Canvas(WIDTH, HEIGHT, shm.buf[:SHARED_SIZE])
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    pool = ConnectionPool.from_args(args, loop=loop)
+    task_client = TaskClient(conn, loop=loop)
+    up = Shard(canvas, task_client)
+
+    session_list = load_sessions(args.user_filename, pool, shard, shards)
+    LOGGER.critical('<shard-%d> loaded %d accounts' %
+                    (shard, len(session_list)))
+    accounts = [Account(worker_id * shards + shard,
+                        user_cookies['DedeUserID'], session)
+                for worker_id, (user_cookies, session)
+                in enumerate(session_list)]
+    handler = functools.partial(repair_pixel, up, task_client,
+                                collections.defaultdict(int))
+    dispatcher = Dispatcher(accounts, task_client, handler, loop=loop)
+    asyncio.ensure_future(dispatcher.run(), loop=loop)
+    asyncio.ensure_future(pool.keep_warm(dispatcher), loop=loop)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(pool.close())
+        task_client.close()
+        # memoryviews must be released before closing the shared memory
+        canvas.buffer.release()
+        shm.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('tasks_filename', metavar='task_file')
+    parser.add_argument('user_filename', metavar='user_file')
+    parser.add_argument('--shards', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="number of worker processes, at most one per "
+                        "account")
+    add_pool_arguments(parser)
+    args = parser.parse_args()
+    if not (3, 8) <= sys.version_info[:2] <= (3, 9):
+        parser.error("Python 3.8 or 3.9 is required")
+    shards = min(args.shards, len(read_user_cmds(args.user_filename)))
+    if shards < 1:
+        parser.error("no accounts in %s" % args.user_filename)
+
+    shm = shared_memory.SharedMemory(create=True, size=SHARED_SIZE)
+    shm.buf[:SHARED_SIZE] = bytes(SHARED_SIZE)
+    canvas = Canvas(WIDTH, HEIGHT, shm.buf[:SHARED_SIZE])
+
+    # start the shards before the event loop and the sessions of this
+    # process exist, so the forked processes don't inherit them
+    pipes = [multiprocessing.Pipe() for _ in range(shards)]
+    processes = [multiprocessing.Process(
+        target=run_shard, args=(shard, shards, shm.name, child_conn, args))
+        for shard, (_, child_conn) in enumerate(pipes)]
+    for process in processes:
+        process.start()
+    for _, child_conn in pipes:
+        child_conn.close()
+    LOGGER.critical("started %d shards" % shards)
+
+    tasks_dict, priority_dict = load_tasks_dict(args.tasks_filename)
+    loop = asyncio.get_event_loop()
+    task_queue = PixelQueue(loop=loop)
+    up = UpdateImage(loop=loop, canvas=canvas, task_queue=task_queue,
+                     guard_region=tasks_dict, guard_priority=priority_dict)
+    # nothing is queued before a full update succeeds
+    up.full_update_callback = functools.partial(
+        populate_tasks, tasks_dict, priority_dict, up, task_queue)
+    server = TaskServer([conn for conn, _ in pipes], task_queue, up.tracker,
+                        loop=loop)
+    loop.run_until_complete(up.perform_update_image())
+    asyncio.ensure_future(up.start_websocket())
+
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        LOGGER.critical("Ctrl-c pressed, exiting")
+        up.close()
+    finally:
+        for process in processes:
+            process.join()
+        loop.run_until_complete(server.close())
+        loop.stop()
+        loop.close()
+        canvas.buffer.release()
+        shm.close()
+        shm.unlink()
+        sys.exit()
+
+
+if __name__ == "__main__":
+    main()
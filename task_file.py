@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+Binary task file format, all fields are little-endian:
+
+32 - header
+    6 - magic "BDTASK"
+    2 - version
+    2 - width
+    2 - height
+    2 - flags
+        1 - has priorities
+        2 - has order
+    4 - number of tasks
+    12 - padding
+width * height / 8 - coverage bitmap, bit (i & 7) of byte (i >> 3) is set
+                     if pixel i = y * width + x is in the task
+width * height - palette index of every pixel, 0xff if not in the task
+width * height * 2 - (optional) int16 priority of every pixel
+count * 4 - (optional) uint32 pixel indexes in task order, row-major order
+            is used if it is missing
+
+Everything is memory-mapped when loading, so the cost doesn't depend on how
+many pixels are in the task.
+"""
+
+import sys
+import json
+import struct
+import numpy as np
+from util import rgb_hex_to_color_code, CODE_INDEX_TABLE, PALETTE_CODES,\
+    CODE_COLOR_TABLE, process_tasks, TaskSet
+
+__all__ = ["TaskFile", "load_tasks", "save_tasks", "load_tasks_dict",
+           "is_binary_task_file"]
+
+MAGIC = b"BDTASK"
+VERSION = 1
+FLAG_PRIORITY = 1
+FLAG_ORDER = 2
+NO_CODE = 0xff
+BINARY_EXTENSION = ".bin"
+
+header_struct = struct.Struct("<6sHHHHI12x")
+
+
+class TaskFile(object):
+    def __init__(self, width, height, coverage, codes, priorities=None,
+                 order=None):
+        self.width = width
+        self.height = height
+        # numpy arrays, coverage is the packed bitmap
+        self.coverage = coverage
+        self.codes = codes
+        self.priorities = priorities
+        self.order = order
+
+    def __len__(self):
+        if self.order is not None:
+            return len(self.order)
+        return int(np.unpackbits(self.coverage, bitorder="little").sum())
+
+    def indexes(self):
+        """pixel indexes in task order
+        """
+        if self.order is not None:
+            return self.order
+        return np.flatnonzero(
+            np.unpackbits(self.coverage, bitorder="little")[
+                :self.width * self.height])
+
+    @classmethod
+    def from_tasks(cls, tasks, priorities=None, width=1280, height=720):
+        """build from [x, y, rgb_hex] tasks, priorities is a dict of
+        (x, y) -> priority
+        """
+        indexes = np.array([y * width + x for x, y, _ in tasks],
+                           dtype=np.int64)
+        codes = np.array([CODE_INDEX_TABLE[rgb_hex_to_color_code(rgb_hex)]
+                          for _, _, rgb_hex in tasks], dtype=np.uint8)
+        task_file = cls.from_arrays(indexes, codes, width, height)
+        if priorities:
+            task_file.priorities = np.zeros(width * height, dtype=np.int16)
+            for (x, y), priority in priorities.items():
+                task_file.priorities[y * width + x] = priority
+        return task_file
+
+    @classmethod
+    def from_arrays(cls, indexes, codes, width=1280, height=720):
+        """build from arrays of pixel indexes and palette indexes in task
+        order, like process_tasks the last color of a pixel wins and the
+        first occurrence decides its order
+        """
+        size = width * height
+        indexes = np.asarray(indexes, dtype=np.int64)
+        codes = np.asarray(codes, dtype=np.uint8)
+        _, first = np.unique(indexes, return_index=True)
+        _, last = np.unique(indexes[::-1], return_index=True)
+        last = len(indexes) - 1 - last
+
+        dense_codes = np.full(size, NO_CODE, dtype=np.uint8)
+        dense_codes[indexes[last]] = codes[last]
+        coverage = np.packbits(dense_codes != NO_CODE, bitorder="little")
+
+        order = indexes[np.sort(first)].astype(np.uint32)
+        # row-major order doesn't need to be saved
+        if np.all(order[1:] > order[:-1]):
+            order = None
+
+        return cls(width, height, coverage, dense_codes, None, order)
+
+    def to_tasks(self):
+        """return [x, y, rgb_hex] tasks and the priorities dict
+        """
+        width = self.width
+        tasks = []
+        priorities = {}
+        for index in self.indexes().tolist():
+            y, x = divmod(index, width)
+            code = PALETTE_CODES[self.codes[index]]
+            tasks.append([x, y, CODE_COLOR_TABLE[code]])
+            if self.priorities is not None and self.priorities[index]:
+                priorities[(x, y)] = int(self.priorities[index])
+        return tasks, priorities
+
+    @classmethod
+    def load(cls, filename):
+        data = np.memmap(filename, dtype=np.uint8, mode="r")
+        magic, version, width, height, flags, count = \
+            header_struct.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError("%s is not a binary task file" % filename)
+        if version != VERSION:
+            raise ValueError("Unsupported task file version %d" % version)
+
+        size = width * height
+        offset = header_struct.size
+        coverage = data[offset:offset + (size + 7) // 8]
+        offset += (size + 7) // 8
+        codes = data[offset:offset + size]
+        offset += size
+        priorities = None
+        if flags & FLAG_PRIORITY:
+            priorities = data[offset:offset + size * 2].view("<i2")
+            offset += size * 2
+        order = None
+        if flags & FLAG_ORDER:
+            order = data[offset:offset + count * 4].view("<u4")
+        return cls(width, height, coverage, codes, priorities, order)
+
+    def save(self, filename):
+        flags = 0
+        if self.priorities is not None:
+            flags |= FLAG_PRIORITY
+        if self.order is not None:
+            flags |= FLAG_ORDER
+        with open(filename, "wb") as fp:
+            fp.write(header_struct.pack(MAGIC, VERSION, self.width,
+                                        self.height, flags, len(self)))
+            fp.write(np.asarray(self.coverage, dtype=np.uint8).tobytes())
+            fp.write(np.asarray(self.codes, dtype=np.uint8).tobytes())
+            if self.priorities is not None:
+                fp.write(np.asarray(self.priorities, dtype="<i2").tobytes())
+            if self.order is not None:
+                fp.write(np.asarray(self.order, dtype="<u4").tobytes())
+
+
+def is_binary_task_file(filename):
+    try:
+        with open(filename, "rb") as fp:
+            return fp.read(len(MAGIC)) == MAGIC
+    except IOError:
+        return False
+
+
+def load_tasks(filename):
+    """return [x, y, rgb_hex] tasks and the priorities dict, from either a
+    JSON or a binary task file
+    """
+    if is_binary_task_file(filename):
+        return TaskFile.load(filename).to_tasks()
+    with open(filename, "r") as fp:
+        return json.load(fp), {}
+
+
+def save_tasks(filename, tasks, priorities=None):
+    """save in binary format if filename ends with .bin, otherwise JSON
+    """
+    if filename.endswith(BINARY_EXTENSION):
+        TaskFile.from_tasks(tasks, priorities).save(filename)
+    else:
+        with open(filename, "w") as fp:
+            json.dump(tasks, fp)
+
+
+def load_tasks_dict(filename):
+    """return the (x, y) -> color code tasks_dict and the priorities dict
+    used by guard.py and draw_pixel.py
+    """
+    if not is_binary_task_file(filename):
+        tasks, priorities = load_tasks(filename)
+        # convert missing colors to available colors, and convert RGB hex to
+        # one-character color code
+        return process_tasks(tasks), priorities
+
+    task_file = TaskFile.load(filename)
+    width = task_file.width
+    tasks_dict = TaskSet.from_task_file(task_file)
+    priorities = {}
+    if task_file.priorities is not None:
+        for index in np.flatnonzero(task_file.priorities).tolist():
+            y, x = divmod(index, width)
+            if (x, y) in tasks_dict:
+                priorities[(x, y)] = int(task_file.priorities[index])
+    return tasks_dict, priorities
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: %s input_file output_file" % sys.argv[0])
+        print("Convert between JSON and binary (%s) task files" %
+              BINARY_EXTENSION)
+        sys.exit()
+
+    tasks, priorities = load_tasks(sys.argv[1])
+    save_tasks(sys.argv[2], tasks, priorities)
+    print("Write %d tasks to %s" % (len(tasks), sys.argv[2]))
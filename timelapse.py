@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Render the snapshots saved by record.py into an animated GIF. Snapshots are
+decoded in a process pool, and every frame only stores the rectangle that
+changed since the previous one, with the unchanged pixels inside it
+transparent. Snapshots without any change are skipped.
+"""
+
+import argparse
+import collections
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image, GifImagePlugin
+from canvas import PALETTE_DATA
+from util import load_palette_lut
+import logger
+
+__all__ = ["decode_snapshot", "GifWriter", "render"]
+
+LOGGER = logger.get_logger('timelapse')
+
+# the 32 colors plus a transparent index, padded to the 64 entries of a GIF
+# color table
+TRANSPARENT = len(PALETTE_DATA) // 3
+GIF_PALETTE = PALETTE_DATA + bytes(64 * 3 - len(PALETTE_DATA))
+
+
+def decode_snapshot(filename):
+    """return the palette index of every pixel of a saved image as a 2D
+    array, the colors are mapped to the nearest ones in the palette
+    """
+    lut = load_palette_lut()
+    with Image.open(filename) as img:
+        if img.mode == "P":
+            # map the few colors of the image palette instead of every pixel
+            rgb = np.array(img.getpalette(), dtype=np.uint32).reshape(-1, 3)
+            table = lut[(rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2]]
+            return table[np.asarray(img)]
+        rgb = np.asarray(img.convert("RGB"), dtype=np.uint32)
+    return lut[(rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]]
+
+
+def palette_image(indexes):
+    img = Image.frombytes("P", (indexes.shape[1], indexes.shape[0]),
+                          indexes.tobytes())
+    img.putpalette(GIF_PALETTE)
+    return img
+
+
+class GifWriter(object):
+    """Write the frames of an animated GIF as they come, only the previous
+    frame is kept in memory
+    """
+
+    def __init__(self, fp, delay=100):
+        self.fp = fp
+        self.delay = delay
+        self.previous = None
+        self.frames = 0
+        self.skipped = 0
+
+    def add(self, frame):
+        """write the frame, return False if it is skipped
+        """
+        if self.previous is None:
+            img = palette_image(frame)
+            header, _ = GifImagePlugin.getheader(
+                img, None, {"loop": 0, "optimize": False})
+            self._write(header)
+            self._write(GifImagePlugin.getdata(
+                img, duration=self.delay, optimize=False))
+        else:
+            changed = frame != self.previous
+            rows = np.flatnonzero(changed.any(axis=1))
+            if len(rows) == 0:
+                self.skipped += 1
+                return False
+            columns = np.flatnonzero(changed.any(axis=0))
+            top, bottom = rows[0], rows[-1] + 1
+            left, right = columns[0], columns[-1] + 1
+            region = frame[top:bottom, left:right].copy()
+            region[~changed[top:bottom, left:right]] = TRANSPARENT
+            # disposal 1 keeps the previous frame under the transparent
+            # pixels
+            self._write(GifImagePlugin.getdata(
+                palette_image(region), offset=(int(left), int(top)),
+                duration=self.delay, transparency=TRANSPARENT, disposal=1,
+                optimize=False))
+        self.previous = frame
+        self.frames += 1
+        return True
+
+    def _write(self, chunks):
+        for chunk in chunks:
+            self.fp.write(chunk)
+
+    def close(self):
+        self.fp.write(b";")
+
+
+def decode_frames(executor, filenames, window):
+    """yield (filename, frame) in order, at most window snapshots are being
+    decoded or waiting to be written
+    """
+    pending = collections.deque()
+    for filename in filenames:
+        pending.append((filename,
+                        executor.submit(decode_snapshot, filename)))
+        if len(pending) >= window:
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
+
+
+def render(filenames, output_filename, *, workers=None, window=None,
+           delay=100):
+    """return the GifWriter after writing the snapshots to the output file
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if window is None:
+        window = workers * 2
+    # build the cached lookup table once instead of in every worker
+    load_palette_lut()
+    with ProcessPoolExecutor(workers) as executor, \
+            open(output_filename, "wb") as fp:
+        writer = GifWriter(fp, delay)
+        for filename, future in decode_frames(executor, filenames, window):
+            try:
+                frame = future.result()
+            except Exception as e:
+                LOGGER.warning("skip %s: %s" % (filename, e))
+                continue
+            if (writer.previous is not None and
+                    frame.shape != writer.previous.shape):
+                LOGGER.warning("skip %s: size %s differs" %
+                               (filename, frame.shape))
+                continue
+            writer.add(frame)
+        if writer.previous is None:
+            raise ValueError("no snapshot is decoded")
+        writer.close()
+    return writer
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output_filename', metavar='output_file')
+    parser.add_argument('--input', default='autosave',
+                        help="folder of the snapshots saved by record.py")
+    parser.add_argument('--delay', type=int, default=100,
+                        help="milliseconds between frames")
+    parser.add_argument('--workers', type=int,
+                        help="number of decoding processes")
+    parser.add_argument('--window', type=int,
+                        help="max number of snapshots held in memory")
+    args = parser.parse_args()
+
+    # the filenames sort by the time they were saved
+    filenames = sorted(glob.glob(os.path.join(args.input, "*.gif")))
+    if not filenames:
+        parser.error("no snapshot found in %s" % args.input)
+    print("Rendering %d snapshots" % len(filenames))
+    writer = render(filenames, args.output_filename, workers=args.workers,
+                    window=args.window, delay=args.delay)
+    print("Save %d frames to %s, %d unchanged snapshots skipped" %
+          (writer.frames, args.output_filename, writer.skipped))
+
+
+if __name__ == "__main__":
+    main()
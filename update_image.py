@@ -1,16 +1,36 @@
 import asyncio
-import collections
 import aiohttp
-import struct
-import time
 import json
-from PIL import Image
-from util import CODE_COLOR_TABLE, hex_to_rgb, CODE_RGB_TABLE
+import os
+import time
+import logging
+import numpy as np
+from util import RGB_CODE_TABLE, API_URL, WEBSOCKET_URL
+from frame_parser import message_header_struct, MessageHeader,\
+    parse_frame, write_corpus
+from canvas import Canvas, indexes_to_image
+from canvas_mirror import MirrorFile, KIND_FULL, read_notification
+from pollution import PollutionTracker
 import logger
 
 __all__ = ["UpdateImage"]
 
-FULL_UPDATE_URL = r"http://api.live.bilibili.com/activity/v1/SummerDraw/bitmap"
+FULL_UPDATE_URL = API_URL + "/bitmap"
+
+# seconds between full updates when the board doesn't drift, the interval
+# starts from REFRESH_INTERVAL
+REFRESH_INTERVAL = 300
+MAX_REFRESH_INTERVAL = 1800
+# mismatch ratios of a full update, up to DRIFT_NOISE_RATIO (about 9 pixels)
+# is the noise of the races between the WebSocket and the download, and the
+# interval is doubled, above DRIFT_RATIO (about 92 pixels) the board drifts
+# and the interval is halved, it is kept in between
+DRIFT_NOISE_RATIO = 1e-5
+DRIFT_RATIO = 1e-4
+
+# seconds between reconnecting attempts, doubled after every failure
+RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 60
 
 TOKEN = bytearray([0x00, 0x00, 0x00, 0x27, 0x00, 0x10, 0x00, 0x01, 0x00, 0x00,
                    0x00, 0x07, 0x00, 0x00, 0x00, 0x01, 0x7B, 0x22, 0x75, 0x69,
@@ -22,31 +42,14 @@ HEART_BEAT_TOKEN = bytearray([0x00, 0x00, 0x00, 0x10, 0x00, 0x10, 0x00, 0x01,
 
 LOGGER = logger.get_logger('update_image')
 
-"""
-Protocol:
-
-4 - JSON message end offset
-2 - JSON message start offset
-2 - unknown1
-4 - opcode
-    3 - something for online
-    5 - msg
-4 - unknown2, padding?
-"""
-message_header_struct = struct.Struct("!IHHI")
-MessageHeader = collections.namedtuple("MessageHeader",
-                                       [
-                                           "end_offset",
-                                           "start_offset",
-                                           "unknown1",
-                                           "opcode",
-                                       ])
+# file extension -> format of save_buffer_to_file
+SAVE_FORMATS = {".gif": "GIF", ".png": "PNG", ".raw": "RAW"}
 
 
 class UpdateImage(object):
     def __init__(self, *, lazy_threshold=60, task_queue=None,
                  guard_region=None, guard_priority=None, loop=None,
-                 connector=None):
+                 connector=None, canvas=None, mirror=None):
         if loop is None:
             loop = asyncio.get_event_loop()
         self.loop = loop
@@ -58,10 +61,24 @@ class UpdateImage(object):
         self.session = aiohttp.ClientSession(loop=loop, connector=connector)
 
         self.full_update_callback = None
+        # called with the list of (x, y, color_code) of every message
+        self.update_callback = None
 
         self.width = 1280
         self.height = 720
-        self.image_buffer = bytearray(self.width * self.height * 3)
+        # attached to the board kept by the mirror daemon, see mirror.py
+        self.mirror = None
+        if mirror is not None:
+            self.mirror = MirrorFile(mirror)
+            canvas = self.mirror.canvas
+        if canvas is None:
+            canvas = Canvas(self.width, self.height)
+        self.canvas = canvas
+        # update lists of the full updates in progress
+        self._pending_updates = []
+        self.tracker = None
+        if guard_region is not None:
+            self.tracker = PollutionTracker(self.canvas, guard_region)
         self.last_update = None
         self.lazy_threshold = lazy_threshold
         self.timeout = 30
@@ -69,16 +86,128 @@ class UpdateImage(object):
 
         self.async_lock = asyncio.Lock(loop=loop)
         self.enable_reconnect = True
+        # seconds between full updates, adapted by measure_drift
+        self.refresh_interval = REFRESH_INTERVAL
+        self.reconcile_task = None
+        # pixels that differed from the downloaded board at the last full
+        # update, their ratio to the board, and per second since the
+        # previous full update
+        self.mismatches = 0
+        self.mismatch_ratio = 0.0
+        self.drift_rate = 0.0
+        # a disconnection longer than this many seconds may have missed
+        # enough updates to need a full update
+        self.resync_gap = 5
+        self.reconnects = 0
+        self.resyncs = 0
+        self.gap_time = 0.0
+        self.max_gap = 0.0
+        # size of the last downloaded bitmap, saved by every resync without
+        # full update
+        self.bitmap_size = 0
+        self.bytes_saved = 0
         self.websocket_task = None
         self.heart_beat_task = None
         self.guard_region_callback = None
-
-    async def perform_update_image(self):
+        # number of WebSocket frames, or notifications of the mirror daemon
+        self.frames = 0
+        # number of pixels applied by apply_updates and the seconds spent
+        self.updates_applied = 0
+        self.update_time = 0.0
+        # file object to record every received frame, see
+        # frame_parser.read_corpus
+        self.frame_corpus = None
+
+    async def perform_update_image(self, pending_updates=None):
         """ Avoid invoking this method in different threads
+
+        The full updates, e.g., of reconcile() and of a resync, run one at a
+        time under async_lock, so a swap never discards the updates replayed
+        by another one.
+        """
+        async with self.async_lock:
+            await self._perform_update_image(pending_updates)
+
+    async def _perform_update_image(self, pending_updates=None):
+        if self.mirror is not None:
+            # the mirror daemon keeps the board current
+            self.last_update = self.mirror.last_full_update or time.time()
+            if self.full_update_callback is not None:
+                self.full_update_callback()
+            return
+        # the WebSocket updates received until the swap are replayed onto
+        # the new board
+        if pending_updates is None:
+            pending_updates = []
+            self._pending_updates.append(pending_updates)
+        try:
+            back_buffer = await self.download_bitmap()
+        finally:
+            self._pending_updates.remove(pending_updates)
+        if back_buffer is None:
+            return
+
+        back = Canvas(self.width, self.height, back_buffer)
+        for x, y, color_code in pending_updates:
+            back.set_code(x, y, color_code)
+        if self.last_update is not None:
+            self.measure_drift(back_buffer)
+        if isinstance(self.canvas.buffer, bytearray):
+            self.canvas.buffer = back_buffer
+        else:
+            # shared memory or a mirror file, other processes map it
+            self.canvas.buffer[:] = back_buffer
+        LOGGER.debug("replayed %d updates received during the full update"
+                     % len(pending_updates))
+        self.last_update = time.time()
+
+        if self.full_update_callback is not None:
+            self.full_update_callback()
+
+    def measure_drift(self, back_buffer):
+        """compare the board with the downloaded one, and adapt the interval
+        of reconciliation to the drift rate
+        """
+        mismatches = int(np.count_nonzero(
+            np.frombuffer(self.canvas.buffer, dtype=np.uint8) !=
+            np.frombuffer(back_buffer, dtype=np.uint8)))
+        elapsed = max(time.time() - self.last_update, 1e-3)
+        self.mismatches = mismatches
+        self.mismatch_ratio = mismatches / len(back_buffer)
+        self.drift_rate = mismatches / elapsed
+        if self.mismatch_ratio > DRIFT_RATIO:
+            self.refresh_interval = max(self.refresh_interval / 2,
+                                        self.lazy_threshold)
+        elif self.mismatch_ratio <= DRIFT_NOISE_RATIO:
+            self.refresh_interval = min(self.refresh_interval * 2,
+                                        MAX_REFRESH_INTERVAL)
+        LOGGER.info("%d pixels drifted in %.0fs, next full update in %ds" %
+                    (mismatches, elapsed, self.refresh_interval))
+
+    async def reconcile(self):
+        """perform a full update every refresh_interval seconds, which is
+        between lazy_threshold and MAX_REFRESH_INTERVAL, shorter when the
+        board drifts and longer when it doesn't
+        """
+        while True:
+            last_update = self.last_update or 0
+            delay = last_update + self.refresh_interval - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay, loop=self.loop)
+                continue
+            await self.perform_update_image()
+            if self.last_update == last_update:
+                # failed, avoid busy loop
+                await asyncio.sleep(self.lazy_threshold, loop=self.loop)
+
+    async def download_bitmap(self):
+        """return the downloaded board as a new buffer, None if failed
         """
         LOGGER.info("Downloading %s" % FULL_UPDATE_URL)
         try:
             r = await self.session.get(FULL_UPDATE_URL, timeout=self.timeout)
+            body = await r.read()
+            self.bitmap_size = len(body)
         except aiohttp.ClientConnectionError:
             LOGGER.error("Failed to connect to Bilibili.com")
             return
@@ -88,24 +217,15 @@ class UpdateImage(object):
         except Exception as e:
             LOGGER.error("Error occurs: %s", e)
             return
+        # json decoding and the conversion of about 1MB take a while, keep
+        # them off the event loop
         try:
-            data = await r.json()
-            code_data = data["data"]["bitmap"]
-        except Exception as e:
-            LOGGER.error("Failed to update image with error: %s" % e)
-            return
-
-        if not isinstance(code_data, str):
-            LOGGER.error("Incorrect code data: %s" % code_data)
-            return
-        if len(code_data) != self.width * self.height:
-            LOGGER.error("Code data length mismatch: %d" % len(code_data))
-
-        convert_code_to_bytes(CODE_COLOR_TABLE, code_data, self.image_buffer)
-        self.last_update = time.time()
-
-        if self.full_update_callback is not None:
-            self.full_update_callback()
+            return await self.loop.run_in_executor(
+                None, decode_bitmap, body, self.width, self.height)
+        except ValueError as e:
+            LOGGER.error("%s" % e)
+        except KeyError as e:
+            LOGGER.error("Unknown color code %s in code data" % e)
 
     async def async_lazy_update_image(self):
         ret = -1
@@ -113,9 +233,9 @@ class UpdateImage(object):
 
         async with self.async_lock:
             if self.last_update is None:
-                await self.perform_update_image()
+                await self._perform_update_image()
             elif time.time() > self.last_update + self.lazy_threshold:
-                await self.perform_update_image()
+                await self._perform_update_image()
             else:
                 ret = self.last_update
         end_time = time.time()
@@ -128,27 +248,35 @@ class UpdateImage(object):
         return ret
 
     def get_image_pixel(self, x, y):
-        index = (y * self.width + x) * 3
-        return tuple(self.image_buffer[index:index + 3])
+        return self.canvas.get_rgb(x, y)
 
     def set_image_pixel(self, x, y, rgb):
-        index = (y * self.width + x) * 3
-        self.image_buffer[index:index + 3] = rgb
+        self.canvas.set_code(x, y, RGB_CODE_TABLE[tuple(rgb)])
 
-    def save_buffer_to_file(self, filename):
-        img = Image.frombytes("RGB", (1280, 720), bytes(self.image_buffer))
-        try:
-            img.save(filename, "GIF")
-        except Exception as err:
-            LOGGER.error("Failed to save file %s with error: %s" %
-                         (filename, err))
+    def save_buffer_to_file(self, filename, format=None):
+        """save the sketch board as GIF, PNG or RAW (one palette index byte
+        per pixel), format is inferred from the filename by default
+        """
+        save_indexes(bytes(self.canvas.buffer), self.width, self.height,
+                     filename, format)
+
+    async def async_save_buffer_to_file(self, filename, format=None):
+        """the same as save_buffer_to_file, but encodes and writes the file
+        in the default executor, only the copy of the board is done on the
+        event loop
+        """
+        await self.loop.run_in_executor(
+            None, save_indexes, bytes(self.canvas.buffer), self.width,
+            self.height, filename, format)
 
     def get_task(self, func):
         task = func(self)
         return task
 
     def on_message(self, message):
-        # TODO: force full update after certain amount of time
+        self.frames += 1
+        if self.frame_corpus is not None:
+            write_corpus(self.frame_corpus, message)
         try:
             message_header = MessageHeader._make(
                 message_header_struct.unpack_from(message)
@@ -169,62 +297,53 @@ class UpdateImage(object):
             return
 
     def process_message(self, message):
-        update_list = []
-        offset = 0
-        while offset < len(message):
-            try:
-                message_header = MessageHeader._make(
-                    message_header_struct.unpack_from(message, offset)
-                )
-                data = message[offset + message_header.start_offset:offset +
-                               message_header.end_offset]
-                message_object = json.loads(data)
-
-                cmd = message_object['cmd']
-                if cmd == "DRAW_UPDATE":
-                    x = message_object['data']['x_max']
-                    y = message_object['data']['y_max']
-                    color_code = message_object['data']['color']
-                    update_list.append([x, y, color_code])
-
-                    LOGGER.debug(
-                        "cmd: %s, update (%d, %d) with color %s" %
-                        (cmd, x, y, color_code))
-                else:
-                    LOGGER.debug("Other message: %s" %
-                                 (data))
-
-                offset += message_header.end_offset
-
-            except Exception as err:
-                LOGGER.error("Error message (offset: %d): %s, err: %s" %
-                             (offset, message, err))
-                break
-
+        update_list, other_messages = parse_frame(message)
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            for x, y, color_code in update_list:
+                LOGGER.debug("cmd: DRAW_UPDATE, update (%d, %d) with color %s"
+                             % (x, y, color_code))
+            for message_object in other_messages:
+                LOGGER.debug("Other message: %s" % message_object)
+        self.apply_updates(update_list)
+
+    def apply_updates(self, update_list, write=True):
+        """write the list of (x, y, color_code) into the canvas, the mirror
+        daemon already wrote them when write is False
+        """
         # finally update the pixels in critical section
-        start_time = time.clock()
+        start_time = time.perf_counter()
+        for pending_updates in self._pending_updates:
+            pending_updates.extend(update_list)
         for x, y, color_code in update_list:
-            rgb = CODE_RGB_TABLE[color_code]
-            self.set_image_pixel(x, y, rgb)
+            if write:
+                self.canvas.set_code(x, y, color_code)
             # ignore when guard_region is not used
-            if self.guard_region is None:
+            if self.tracker is None:
                 continue
-            # check guard region
-            if (x, y) in self.guard_region:
+            # only a correct pixel turning polluted needs a new task, an
+            # already polluted pixel is waiting in the task queue
+            if self.tracker.update(x, y):
                 desired_color_code = self.guard_region[(x, y)]
-                if desired_color_code != color_code:
-                    LOGGER.info("(%d, %d) %s triggers the guard region",
-                                x, y, color_code)
+                LOGGER.info("(%d, %d) %s triggers the guard region",
+                            x, y, color_code)
+
+                self.task_queue.put_nowait(
+                    (self.get_task_priority(x, y),
+                     x,
+                     y,
+                     desired_color_code)
+                )
+            elif not self.tracker.is_polluted(x, y):
+                # repaired by someone else, don't waste a cool-down on it
+                self.task_queue.discard(x, y)
 
-                    self.task_queue.put_nowait(
-                        (self.get_task_priority(x, y),
-                         x,
-                         y,
-                         desired_color_code)
-                    )
+        if self.update_callback is not None:
+            self.update_callback(update_list)
 
-        LOGGER.debug("process_message update pixels in %.6f" %
-                     (time.clock() - start_time))
+        cost = time.perf_counter() - start_time
+        self.updates_applied += len(update_list)
+        self.update_time += cost
+        LOGGER.debug("apply_updates update pixels in %.6f" % cost)
 
     def on_error(self):
         """
@@ -251,36 +370,129 @@ class UpdateImage(object):
             await asyncio.sleep(30)
 
     async def start_websocket(self):
-        async with self.session.ws_connect(
-                r"ws://broadcastlv.chat.bilibili.com:2244/sub") as ws:
-            self.ws = ws
-            await ws.send_bytes(TOKEN)
-            self.heart_beat_task = asyncio.ensure_future(self.heart_beat())
-            async for msg in ws:
-                if msg.type == aiohttp.WSMsgType.BINARY:
-                    self.on_message(msg.data)
-                elif msg.type == aiohttp.WSMsgType.CLOSED:
-                    self.on_close()
-                elif msg.type == aiohttp.WSMsgType.ERROR:
-                    self.on_error()
-
-        # cancel previous heart beat coroutine
-        if self.heart_beat_task:
-            self.heart_beat_task.cancel()
+        """receive the updates, reconnect with backoff when disconnected
+
+        The WebSocket is reconnected before anything else, so the updates
+        after reconnecting are not lost. The board is downloaded again in the
+        background only when the gap is longer than resync_gap seconds.
+        """
+        if self.mirror is not None:
+            return await self.start_mirror_listener()
+        if self.reconcile_task is None:
+            # catch the updates lost by the WebSocket
+            self.reconcile_task = asyncio.ensure_future(self.reconcile(),
+                                                        loop=self.loop)
+        delay = RECONNECT_DELAY
+        disconnected_at = None
+        while True:
+            connected_at = None
+            try:
+                async with self.session.ws_connect(WEBSOCKET_URL) as ws:
+                    self.ws = ws
+                    await ws.send_bytes(TOKEN)
+                    connected_at = self.loop.time()
+                    self.start_time = time.time()
+                    self.heart_beat_task = asyncio.ensure_future(
+                        self.heart_beat())
+                    if disconnected_at is not None:
+                        self.resync(connected_at - disconnected_at)
+                    async for msg in ws:
+                        if msg.type == aiohttp.WSMsgType.BINARY:
+                            self.on_message(msg.data)
+                        elif msg.type == aiohttp.WSMsgType.CLOSED:
+                            self.on_close()
+                        elif msg.type == aiohttp.WSMsgType.ERROR:
+                            self.on_error()
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                LOGGER.error("WebSocket error: %s" % e)
+            finally:
+                # cancel previous heart beat coroutine
+                if self.heart_beat_task:
+                    self.heart_beat_task.cancel()
+                    self.heart_beat_task = None
+
+            if not self.enable_reconnect:
+                return
+            if connected_at is not None:
+                # a failed attempt doesn't end the gap
+                disconnected_at = self.loop.time()
+                if disconnected_at - connected_at > MAX_RECONNECT_DELAY:
+                    delay = RECONNECT_DELAY
+            LOGGER.info("reconnecting WebSocket in %.1fs" % delay)
+            await asyncio.sleep(delay, loop=self.loop)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    def resync(self, gap):
+        """called after reconnecting, gap is the seconds without WebSocket
+        """
+        self.reconnects += 1
+        self.gap_time += gap
+        self.max_gap = max(self.max_gap, gap)
+        if gap > self.resync_gap or self.last_update is None:
+            self.resyncs += 1
+            self.start_full_update()
+        else:
+            self.bytes_saved += self.bitmap_size
+        LOGGER.info("WebSocket reconnected after %.2fs, %s" %
+                    (gap, self.resync_summary()))
 
-        # force a full update and reconnect WebSocket
-        if self.enable_reconnect:
-            LOGGER.info("reconnecting WebSocket")
+    def start_full_update(self):
+        """perform a full update in the background, every update received
+        from now on is replayed onto the downloaded board
+        """
+        pending_updates = []
+        self._pending_updates.append(pending_updates)
+        return asyncio.ensure_future(
+            self.perform_update_image(pending_updates), loop=self.loop)
+
+    def resync_summary(self):
+        return ("%d reconnects, %d full updates, %.2fs max gap, %.2fs total "
+                "gap, %d bytes saved" %
+                (self.reconnects, self.resyncs, self.max_gap, self.gap_time,
+                 self.bytes_saved))
+
+    async def start_mirror_listener(self):
+        """receive the changes from the mirror daemon instead of opening
+        another WebSocket
+        """
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(
+                    self.mirror.socket_path, loop=self.loop)
+            except OSError as e:
+                LOGGER.error("cannot connect to the mirror daemon: %s" % e)
+                await asyncio.sleep(5, loop=self.loop)
+                continue
+            # changes may be missed while disconnected
             await self.perform_update_image()
-            self.websocket_task = asyncio.ensure_future(self.start_websocket())
+            try:
+                while True:
+                    kind, seq, update_list = await read_notification(reader)
+                    self.frames += 1
+                    LOGGER.debug("mirror sequence %d" % seq)
+                    if kind == KIND_FULL:
+                        await self.perform_update_image()
+                    else:
+                        self.apply_updates(update_list, write=False)
+            except asyncio.IncompleteReadError:
+                LOGGER.error("mirror daemon closed the connection")
+            finally:
+                writer.close()
+            if not self.enable_reconnect:
+                return
+            await asyncio.sleep(1, loop=self.loop)
 
     def close(self):
         if self.heart_beat_task:
             self.heart_beat_task.cancel()
         if self.websocket_task:
             self.websocket_task.cancel()
+        if self.reconcile_task:
+            self.reconcile_task.cancel()
         if self.session:
             self.session.close()
+        if self.mirror is not None:
+            self.mirror.close()
 
     def get_task_priority(self, x, y):
         if self.guard_priority is None:
@@ -289,11 +501,31 @@ class UpdateImage(object):
             return self.guard_priority.get((x, y), self.defualt_priority)
 
 
-def convert_code_to_bytes(CODE_COLOR_TABLE, code_data, buf):
-    i = 0
-    for code in code_data:
-        rgb_hex = CODE_COLOR_TABLE[code]
-        rgb = hex_to_rgb(rgb_hex)
-        buf[i:i + 3] = rgb
-        i += 3
-    return buf
+def decode_bitmap(body, width=1280, height=720):
+    """decode the response body of FULL_UPDATE_URL into a new buffer of
+    palette indexes, it runs in an executor
+    """
+    try:
+        code_data = json.loads(body.decode('utf-8'))["data"]["bitmap"]
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError("Failed to update image with error: %s" % e)
+    if not isinstance(code_data, str):
+        raise ValueError("Incorrect code data: %s" % code_data)
+    canvas = Canvas(width, height)
+    canvas.load_codes(code_data)
+    return canvas.buffer
+
+
+def save_indexes(indexes, width, height, filename, format=None):
+    if format is None:
+        format = SAVE_FORMATS.get(os.path.splitext(filename)[1].lower(),
+                                  "GIF")
+    try:
+        if format.upper() == "RAW":
+            with open(filename, "wb") as fp:
+                fp.write(indexes)
+        else:
+            indexes_to_image(indexes, width, height).save(filename, format)
+    except Exception as err:
+        LOGGER.error("Failed to save file %s with error: %s" %
+                     (filename, err))
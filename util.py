@@ -1,10 +1,15 @@
+import os
 import time
 import re
-import collections
 import json
+import array
+import hashlib
+import tempfile
 from datetime import datetime
+import numpy as np
 from colormath.color_objects import sRGBColor, LabColor
 from colormath.color_conversions import convert_color
+from colormath import color_constants
 import aiohttp
 
 
@@ -66,6 +71,13 @@ RGB_CODE_TABLE = {hex_to_rgb(k): v for k, v in COLOR_CODE_TABLE.items()}
 # '1' -> (255, 255, 255)
 CODE_RGB_TABLE = {v: k for k, v in RGB_CODE_TABLE.items()}
 
+# palette index -> color code, the color codes happen to be base-32 digits
+PALETTE_CODES = '0123456789ABCDEFGHIJKLMNOPQRSTUV'
+assert set(PALETTE_CODES) == set(CODE_COLOR_TABLE.keys())
+
+# 'G' -> 16
+CODE_INDEX_TABLE = {code: index for index, code in enumerate(PALETTE_CODES)}
+
 missing_color_table = {
     "#f0fdf3": "#ffffff",
     '#137b9f': '#057197',
@@ -113,16 +125,204 @@ def rgb_hex_to_color_code(rgb_hex):
 def find_nearest_color(r, g, b):
     """return the RGB hex of the nearest color in available palette
     """
+    index = load_palette_lut()[(r << 16) | (g << 8) | b]
+    return CODE_COLOR_TABLE[PALETTE_CODES[index]]
+
+
+def find_nearest_color_lab(r, g, b):
+    """slow version of find_nearest_color without the lookup table
+    """
     lab_color = rgb_to_lab(r, g, b)
     nearest_lab = min(lab_map.keys(), key=lambda x: dist(lab_color, x))
     return lab_map[nearest_lab]
 
 
+# RGB (r << 16 | g << 8 | b) -> palette index of the nearest color, it is
+# built once and cached next to this file
+PALETTE_LUT_FILENAME = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "palette_lut.bin")
+PALETTE_LUT_MAGIC = b"BDLUT1"
+_palette_lut = None
+
+
+def palette_digest():
+    """identify the palette, the cached lookup table is rebuilt when it
+    changes
+    """
+    palette = ",".join("%s%s" % (code, CODE_COLOR_TABLE[code])
+                       for code in PALETTE_CODES)
+    return hashlib.sha256(palette.encode("ascii")).digest()
+
+
+def rgb_array_to_lab(rgb):
+    """vectorized rgb_to_lab for an (N, 3) array, following the same sRGB ->
+    XYZ -> Lab steps as colormath
+    """
+    rgb = np.asarray(rgb, dtype=np.float64)
+    linear = np.where(rgb <= 0.04045, rgb / 12.92,
+                      np.power((rgb + 0.055) / 1.055, 2.4))
+    xyz = linear @ sRGBColor.conversion_matrices["rgb_to_xyz"].T
+    xyz /= color_constants.ILLUMINANTS["2"]["d65"]
+    xyz = np.where(xyz > color_constants.CIE_E, np.cbrt(xyz),
+                   7.787 * xyz + 16.0 / 116.0)
+    lab = np.empty_like(xyz)
+    lab[:, 0] = 116.0 * xyz[:, 1] - 16.0
+    lab[:, 1] = 500.0 * (xyz[:, 0] - xyz[:, 1])
+    lab[:, 2] = 200.0 * (xyz[:, 1] - xyz[:, 2])
+    return lab
+
+
+def build_palette_lut():
+    palette_lab = np.array([rgb_to_lab(*CODE_RGB_TABLE[code])
+                            for code in PALETTE_CODES])
+    # |lab - p|^2 = |lab|^2 - 2 lab.p + |p|^2, and |lab|^2 doesn't change
+    # the argmin
+    palette_norm = (palette_lab**2).sum(axis=1)
+    lut = np.empty(1 << 24, dtype=np.uint8)
+    low = np.arange(1 << 16)
+    rgb = np.empty((1 << 16, 3))
+    rgb[:, 1] = low >> 8
+    rgb[:, 2] = low & 0xff
+    # one red value at a time, to keep the distance matrix small
+    for r in range(256):
+        rgb[:, 0] = r
+        lab = rgb_array_to_lab(rgb)
+        distance = palette_norm - 2 * lab @ palette_lab.T
+        lut[r << 16:(r + 1) << 16] = distance.argmin(axis=1)
+    return lut
+
+
+def load_palette_lut(filename=PALETTE_LUT_FILENAME):
+    """return the RGB -> palette index lookup table, build and save it if
+    the cached one is missing or out of date
+    """
+    global _palette_lut
+    if _palette_lut is not None:
+        return _palette_lut
+
+    header = PALETTE_LUT_MAGIC + palette_digest()
+    size = len(header) + (1 << 24)
+    try:
+        with open(filename, "rb") as fp:
+            cached = (fp.read(len(header)) == header and
+                      os.fstat(fp.fileno()).st_size == size)
+    except IOError:
+        cached = False
+
+    if not cached:
+        lut = build_palette_lut()
+        # write a temporary file and rename it, so neither an interrupted
+        # write nor another process building it at the same time leaves a
+        # truncated table behind
+        directory, basename = os.path.split(os.path.abspath(filename))
+        tmp_filename = None
+        try:
+            fd, tmp_filename = tempfile.mkstemp(prefix=basename + ".",
+                                                dir=directory)
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(header)
+                lut.tofile(fp)
+            os.replace(tmp_filename, filename)
+        except IOError as e:
+            print("Failed to cache palette lookup table %s: %s" %
+                  (filename, e))
+            if tmp_filename is not None and os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            _palette_lut = lut
+            return lut
+
+    _palette_lut = np.memmap(filename, dtype=np.uint8, mode="r",
+                             offset=len(header), shape=(1 << 24,))
+    return _palette_lut
+
+
+class TaskSet(object):
+    """Compact ordered mapping of (x, y) -> color code
+
+    It is backed by a dense palette index array, a presence bitmap and an
+    array of pixel indexes in insertion order, which takes about 5 bytes per
+    pixel instead of hundreds for an OrderedDict.
+    """
+    __slots__ = ('width', 'height', 'codes', 'presence', 'order')
+
+    def __init__(self, width=1280, height=720):
+        self.width = width
+        self.height = height
+        self.codes = bytearray(width * height)
+        self.presence = bytearray((width * height + 7) // 8)
+        self.order = array.array('I')
+
+    @classmethod
+    def from_task_file(cls, task_file):
+        """copy the memory-mapped arrays of a task_file.TaskFile
+        """
+        task_set = cls(task_file.width, task_file.height)
+        task_set.codes[:] = task_file.codes.tobytes()
+        task_set.presence[:] = task_file.coverage.tobytes()
+        task_set.order.frombytes(
+            task_file.indexes().astype(np.uint32).tobytes())
+        return task_set
+
+    def _index(self, key):
+        x, y = key
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return y * self.width + x
+        return -1
+
+    def _present(self, index):
+        return index >= 0 and self.presence[index >> 3] >> (index & 7) & 1
+
+    def __contains__(self, key):
+        return self._present(self._index(key))
+
+    def __getitem__(self, key):
+        index = self._index(key)
+        if not self._present(index):
+            raise KeyError(key)
+        return PALETTE_CODES[self.codes[index]]
+
+    def __setitem__(self, key, color_code):
+        index = self._index(key)
+        if index < 0:
+            raise KeyError(key)
+        if not self._present(index):
+            self.presence[index >> 3] |= 1 << (index & 7)
+            self.order.append(index)
+        self.codes[index] = CODE_INDEX_TABLE[color_code]
+
+    def get(self, key, default=None):
+        index = self._index(key)
+        if not self._present(index):
+            return default
+        return PALETTE_CODES[self.codes[index]]
+
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+        width = self.width
+        for index in self.order:
+            yield (index % width, index // width)
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        codes = self.codes
+        for index in self.order:
+            yield PALETTE_CODES[codes[index]]
+
+    def items(self):
+        width = self.width
+        codes = self.codes
+        for index in self.order:
+            yield (index % width, index // width), PALETTE_CODES[codes[index]]
+
+
 def process_tasks(tasks):
     """in-place tasks processing, convert missing colors to available colors
     """
-    # TODO: it might be better to use collections.defaultdict(str)
-    tasks_dict = collections.OrderedDict()
+    tasks_dict = TaskSet()
     for i in range(len(tasks)):
         x, y, rgb_hex = tasks[i]
         if rgb_hex not in COLOR_CODE_TABLE:
@@ -140,7 +340,13 @@ fake_request_header = {
     'Referer': r'http://live.bilibili.com/pages/1702/pixel-drawing'
 }
 
-post_url = r'http://api.live.bilibili.com/activity/v1/SummerDraw/draw'
+# BDRAW_API_URL and BDRAW_WS_URL point the tools to another server, e.g.,
+# the stand-in server of fake_server.py
+API_URL = os.environ.get(
+    'BDRAW_API_URL', r'http://api.live.bilibili.com/activity/v1/SummerDraw')
+WEBSOCKET_URL = os.environ.get(
+    'BDRAW_WS_URL', r'ws://broadcastlv.chat.bilibili.com:2244/sub')
+post_url = API_URL + '/draw'
 cookie_pattern = r"-H 'Cookie: ([^']+)'"
 
 
@@ -188,8 +394,10 @@ async def async_draw_pixel_with_requests(session, x, y, color_code):
     return status_code, wait_time, time.time() - start_time
 
 
-def process_status_101(user_counters, worker_id, user_id, cost_time, workers):
-    # use a list container to hold an integer
+def process_status_101(user_counters, worker_id, user_id, cost_time):
+    """return True if the cookie is considered invalid and the account should
+    be retired
+    """
     user_counters[user_id] += 1
     times = user_counters[user_id]
     print("@%s, <worker-%s> has status -101 for %d times, cost %.2fs"
@@ -199,4 +407,5 @@ def process_status_101(user_counters, worker_id, user_id, cost_time, workers):
         print("@%s, <worker-%s> exiting because of invalid cookie, associated"
               " uid: %s" %
               (datetime.now(), worker_id, user_id))
-        workers[worker_id].cancel()
+        return True
+    return False